@@ -29,6 +29,14 @@ DEFAULT_CFG = {
         },
     ],
     "health_facility_contract_dates_mandatory": False,
+    # "db" (contains search, trigram indexes on PostgreSQL) or "ngram" (in-memory index)
+    "location_search_backend": "db",
+    "location_search_limit": 50,
+    # subtree work of the delete/move location mutations: "sync", "thread" (in-process executor) or "celery"
+    "location_background_mutations": "sync",
+    # maintain the user_location_scope table (to build with the rebuild_user_location_scope command once enabled),
+    # joined by LocationManager.allowed on MSSQL
+    "location_user_scope_table": False,
 }
 
 
@@ -49,6 +57,10 @@ class LocationConfig(AppConfig):
 
     health_facility_level = []
     health_facility_contract_dates_mandatory = None
+    location_search_backend = None
+    location_search_limit = None
+    location_background_mutations = None
+    location_user_scope_table = None
 
     def __load_config(self, cfg):
         for field in cfg:
@@ -60,6 +72,19 @@ class LocationConfig(AppConfig):
 
         cfg = ModuleConfiguration.get_or_default(MODULE_NAME, DEFAULT_CFG)
         self.__load_config(cfg)
+        self.__connect_claim_admin_receivers()
+
+    @staticmethod
+    def __connect_claim_admin_receivers():
+        # the claim module is optional, the cached claim admin scopes are evicted only if it is there
+        from django.apps import apps
+        from django.db.models.signals import post_save, post_delete
+
+        if apps.is_installed("claim"):
+            from .models import claim_admin_changed
+
+            post_save.connect(claim_admin_changed, sender="claim.ClaimAdmin")
+            post_delete.connect(claim_admin_changed, sender="claim.ClaimAdmin")
 
     def set_dataloaders(self, dataloaders):
         from .dataloaders import LocationLoader, HealthFacilityLoader
@@ -0,0 +1,130 @@
+import csv
+import json
+
+from core import filter_validity
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .apps import LocationConfig
+from .models import HealthFacility, Location, LocationManager
+
+EXPORT_CHUNK_SIZE = 2000
+LOCATION_EXPORT_VALUES = [
+    "uuid",
+    "code",
+    "name",
+    "type",
+    "male_population",
+    "female_population",
+    "other_population",
+    "families",
+]
+HEALTH_FACILITY_EXPORT_VALUES = {
+    "uuid": "uuid",
+    "code": "code",
+    "name": "name",
+    "acc_code": "acc_code",
+    "legal_form": "legal_form_id",
+    "level": "level",
+    "sub_level": "sub_level_id",
+    "location_code": "location__code",
+    "region_code": "location__parent__code",
+    "address": "address",
+    "phone": "phone",
+    "fax": "fax",
+    "email": "email",
+    "care_type": "care_type",
+    "status": "status",
+    "services_pricelist": "services_pricelist__name",
+    "items_pricelist": "items_pricelist__name",
+    "offline": "offline",
+    "contract_start_date": "contract_start_date",
+    "contract_end_date": "contract_end_date",
+}
+
+
+def location_export_fields():
+    """Columns of the location export: the location itself, its parent and the code of each of its ancestors"""
+    return (
+        LOCATION_EXPORT_VALUES[:4]
+        + ["parent_code"]
+        + [f"{loc_type}_code" for loc_type in LocationConfig.location_types[:-1]]
+        + LOCATION_EXPORT_VALUES[4:]
+    )
+
+
+def export_locations(user=None):
+    """
+    Stream the valid locations as dicts, level by level (parents always come before their children),
+    with the codes of the ancestors denormalized on each row.
+    The rows are read through a server-side cursor, the whole table is never loaded in memory.
+    :param user: only export the locations this user can see, None for all
+    """
+    scope = LocationManager().get_user_scope(user) if user is not None else None
+    for level, loc_type in enumerate(LocationConfig.location_types):
+        ancestors = LocationConfig.location_types[:level]
+        # "parent__code", "parent__parent__code", ... the closest ancestor first
+        ancestor_lookups = ["__".join(["parent"] * depth + ["code"]) for depth in range(1, level + 1)]
+        queryset = Location.objects.filter(*filter_validity(), type=loc_type).order_by("code")
+        for row in queryset.values("id", *LOCATION_EXPORT_VALUES, *ancestor_lookups).iterator(
+            chunk_size=EXPORT_CHUNK_SIZE
+        ):
+            if scope is not None and row["id"] not in scope:
+                continue
+            del row["id"]
+            row["parent_code"] = row.get("parent__code")
+            for depth, ancestor_type in enumerate(reversed(ancestors), start=1):
+                row[f"{ancestor_type}_code"] = row.pop(ancestor_lookups[depth - 1])
+            yield row
+
+
+def export_health_facilities(user=None):
+    """
+    Stream the valid health facilities as dicts, with the codes/names of their references.
+    :param user: only export the health facilities located in the districts this user can see, None for all
+    """
+    scope = LocationManager().get_user_scope(user) if user is not None else None
+    queryset = HealthFacility.objects.filter(*filter_validity()).order_by("code")
+    for row in queryset.values("location_id", *HEALTH_FACILITY_EXPORT_VALUES.values()).iterator(
+        chunk_size=EXPORT_CHUNK_SIZE
+    ):
+        if scope is not None and row["location_id"] not in scope:
+            continue
+        yield {field: row[lookup] for field, lookup in HEALTH_FACILITY_EXPORT_VALUES.items()}
+
+
+class _Echo:
+    """Pseudo-buffer handing back what the csv writer writes, to stream it line by line"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(fields, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([row.get(field) for field in fields])
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + "\n"
+
+
+def export_lines(what, file_format, user=None):
+    """
+    :param what: "locations" or "health_facilities"
+    :param file_format: "csv" or "ndjson"
+    :return: generator of the lines of the export
+    """
+    if what == "locations":
+        rows, fields = export_locations(user), location_export_fields()
+    elif what == "health_facilities":
+        rows, fields = export_health_facilities(user), list(HEALTH_FACILITY_EXPORT_VALUES)
+    else:
+        raise ValueError(f"Unsupported export: {what}")
+    if file_format == "csv":
+        return csv_lines(fields, rows)
+    if file_format in ("json", "ndjson", "jsonl"):
+        return ndjson_lines(rows)
+    raise ValueError(f"Unsupported export format: {file_format}")
@@ -1,17 +1,25 @@
 import graphene
 from .apps import LocationConfig
-from core import assert_string_length, filter_validity
+from core import assert_string_length
 from core.schema import OpenIMISMutation
-from .models import Location, HealthFacility, UserDistrict
+from .models import (
+    Location,
+    HealthFacility,
+    LocationMutation,
+    HealthFacilityMutation,
+    chunked,
+    deferred_location_cache_invalidation,
+)
+from core import filter_validity
 from django.contrib.auth.models import AnonymousUser
 from django.core.exceptions import ValidationError, PermissionDenied
+from django.db import transaction
 from django.utils.translation import gettext as _
 from graphene import InputObjectType
-from django.core.cache import cache
 
-import copy
-
-from .services import LocationService, HealthFacilityService
+from .importers import HealthFacilityImportService, LocationImportService
+from .services import LocationService, HealthFacilityService, update_mutation_log_ext
+from .tasks import submit_location_operation
 
 
 class LocationCodeInputType(graphene.String):
@@ -43,6 +51,47 @@ class LocationInputType(OpenIMISMutation.Input):
     parent_uuid = graphene.String(required=False)
 
 
+def link_mutation(link_model, user, mutation_log_id, client_mutation_id, **target):
+    """
+    Link the mutated record to its mutation log, with the instance already known to the mutation.
+    Without the mutation log id (mutations replayed from their json content), fall back on the client mutation id.
+    """
+    if any(record is None for record in target.values()):
+        return
+    if mutation_log_id:
+        link_model.objects.create(
+            mutation_id=mutation_log_id,
+            **{f"{field}_id": record.id for field, record in target.items()},
+        )
+    elif client_mutation_id:
+        link_model.object_mutated(user, client_mutation_id=client_mutation_id, **target)
+
+
+def save_and_link(save, data, user, link_model, field):
+    """
+    Save a record with save(data, user) and link the instance it returns to the mutation log.
+    A failed update is linked too: only then is its record looked up by uuid.
+    """
+    mutation_log_id = data.pop("mutation_log_id", None)
+    client_mutation_id = data.get("client_mutation_id")
+    record_uuid = data.get("uuid")
+    try:
+        record = save(data, user)
+    except Exception:
+        if record_uuid:
+            model = link_model._meta.get_field(field).related_model
+            link_mutation(
+                link_model,
+                user,
+                mutation_log_id,
+                client_mutation_id,
+                **{field: model.objects.filter(uuid=record_uuid).first()},
+            )
+        raise
+    link_mutation(link_model, user, mutation_log_id, client_mutation_id, **{field: record})
+    return record
+
+
 def update_or_create_location(data, user):
     if "client_mutation_id" in data:
         data.pop("client_mutation_id")
@@ -63,7 +112,7 @@ class CreateOrUpdateLocationMutation(OpenIMISMutation):
         from core.utils import TimeUtils
 
         data["validity_from"] = TimeUtils.now()
-        update_or_create_location(data, user)
+        save_and_link(update_or_create_location, data, user, LocationMutation, "location")
         return None
 
 
@@ -76,11 +125,6 @@ class CreateLocationMutation(CreateOrUpdateLocationMutation):
 
     @classmethod
     def async_mutate(cls, user, **data):
-
-        if Location.objects.filter(
-            code=data["code"], type=data["type"], validity_to=None
-        ).exists():
-            raise ValidationError("Location with this code already exists.")
         try:
             return cls.do_mutate(
                 LocationConfig.gql_mutation_create_locations_perms, user, **data
@@ -118,16 +162,6 @@ class UpdateLocationMutation(CreateOrUpdateLocationMutation):
             ]
 
 
-def tree_delete(parents, now):
-    if parents:
-        children = Location.objects.filter(
-            parent__in=parents
-        )  # .filter(*filter_validity())
-        org_children = copy.copy(children)
-        children.update(validity_to=now)
-        tree_delete(org_children, now)
-
-
 class DeleteLocationMutation(OpenIMISMutation):
     _mutation_module = "location"
     _mutation_class = "DeleteLocationMutation"
@@ -140,25 +174,25 @@ class DeleteLocationMutation(OpenIMISMutation):
     @classmethod
     def async_mutate(cls, user, **data):
         try:
+            mutation_log_id = data.pop("mutation_log_id", None)
             if not user.has_perms(LocationConfig.gql_mutation_delete_locations_perms):
                 raise PermissionDenied(_("unauthorized"))
             location = Location.objects.get(uuid=data["uuid"])
             np_uuid = data.get("new_parent_uuid", None)
-            from core import datetime
-
-            now = datetime.datetime.now()
-            if np_uuid:
-                new_parent = Location.objects.get(uuid=np_uuid)
-                Location.objects.filter(parent=location).filter(
-                    *filter_validity()
-                ).update(parent=new_parent)
-            else:
-                tree_delete((location,), now)
-
-            location.validity_to = now
-            location.save()
-            if location.type == "D":
-                cls.__delete_user_districts(location, now)
+            new_parent = Location.objects.get(uuid=np_uuid) if np_uuid else None
+            link_mutation(
+                LocationMutation,
+                user,
+                mutation_log_id,
+                data.get("client_mutation_id"),
+                location=location,
+            )
+            submit_location_operation(
+                mutation_log_id,
+                "delete",
+                location_id=location.id,
+                new_parent_id=new_parent.id if new_parent else None,
+            )
             return None
         except Exception as exc:
             return [
@@ -169,30 +203,6 @@ class DeleteLocationMutation(OpenIMISMutation):
                 }
             ]
 
-    @classmethod
-    def __delete_user_districts(cls, location: Location, location_delete_date=None):
-
-        if location_delete_date is None:
-            from core import datetime
-
-            location_delete_date = datetime.datetime.now()
-
-        UserDistrict.objects.filter(location=location, validity_to__isnull=True).update(
-            validity_to=location_delete_date
-        )
-
-
-def tree_reset_types(parent, location, new_level):
-    if new_level >= len(LocationConfig.location_types):
-        location.parent = parent.parent
-        location.type = LocationConfig.location_types[-1]
-        return
-    location.type = LocationConfig.location_types[new_level]
-    for child in location.children.filter(*filter_validity()).all():
-        child.save_history()
-        tree_reset_types(location, child, new_level + 1)
-        child.save()
-
 
 class MoveLocationMutation(OpenIMISMutation):
     _mutation_module = "location"
@@ -205,22 +215,25 @@ class MoveLocationMutation(OpenIMISMutation):
     @classmethod
     def async_mutate(cls, user, **data):
         try:
+            mutation_log_id = data.pop("mutation_log_id", None)
             if not user.has_perms(LocationConfig.gql_mutation_move_location_perms):
                 raise PermissionDenied(_("unauthorized"))
             location = Location.objects.get(uuid=data["uuid"])
-            location.save_history()
-            level = LocationConfig.location_types.index(location.type)
             np_uuid = data.get("new_parent_uuid", None)
             new_parent = Location.objects.get(uuid=np_uuid) if np_uuid else None
-            np_level = (
-                LocationConfig.location_types.index(new_parent.type)
-                if new_parent
-                else -1
+            link_mutation(
+                LocationMutation,
+                user,
+                mutation_log_id,
+                data.get("client_mutation_id"),
+                location=location,
+            )
+            submit_location_operation(
+                mutation_log_id,
+                "move",
+                location_id=location.id,
+                new_parent_id=new_parent.id if new_parent else None,
             )
-            location.parent = new_parent
-            if np_level < level - 1 or np_level >= level:
-                tree_reset_types(new_parent, location, np_level + 1)
-            location.save()
             return None
         except Exception as exc:
             return [
@@ -297,8 +310,6 @@ class CreateHealthFacilityMutation(OpenIMISMutation):
     @classmethod
     def async_mutate(cls, user, **data):
         try:
-            if HealthFacilityService.check_unique_code(data.get("code")):
-                raise ValidationError(_("mutation.hf_code_duplicated"))
             if type(user) is AnonymousUser or not user.id:
                 raise ValidationError(_("mutation.authentication_required"))
             if not user.has_perms(
@@ -310,7 +321,13 @@ class CreateHealthFacilityMutation(OpenIMISMutation):
             from core.utils import TimeUtils
 
             data["validity_from"] = TimeUtils.now()
-            update_or_create_health_facility(data, user)
+            save_and_link(
+                update_or_create_health_facility,
+                data,
+                user,
+                HealthFacilityMutation,
+                "health_facility",
+            )
             return None
         except Exception as exc:
             return [
@@ -339,17 +356,17 @@ class UpdateHealthFacilityMutation(OpenIMISMutation):
             ):
                 raise PermissionDenied(_("unauthorized"))
 
-            incoming_HF_code = data["code"]
-            current_HF = HealthFacility.objects.get(uuid=data["uuid"])
-            if current_HF.code != incoming_HF_code:
-                if HealthFacilityService.check_unique_code(incoming_HF_code):
-                    raise ValidationError(_("mutation.hf_code_duplicated"))
-
             data["audit_user_id"] = user.id_for_audit
             from core.utils import TimeUtils
 
             data["validity_from"] = TimeUtils.now()
-            update_or_create_health_facility(data, user)
+            save_and_link(
+                update_or_create_health_facility,
+                data,
+                user,
+                HealthFacilityMutation,
+                "health_facility",
+            )
             return None
         except Exception as exc:
             return [
@@ -377,6 +394,13 @@ class DeleteHealthFacilityMutation(OpenIMISMutation):
             ):
                 raise PermissionDenied(_("unauthorized"))
             hf = HealthFacility.objects.get(uuid=data["uuid"])
+            link_mutation(
+                HealthFacilityMutation,
+                user,
+                data.pop("mutation_log_id", None),
+                data.get("client_mutation_id"),
+                health_facility=hf,
+            )
 
             from core import datetime
 
@@ -392,3 +416,241 @@ class DeleteHealthFacilityMutation(OpenIMISMutation):
                     "detail": str(exc),
                 }
             ]
+
+
+# key of the per-item results of the batch mutations in the json_ext of the mutation log
+BATCH_RESULTS_KEY = "location_batch"
+
+
+def record_batch_results(mutation_log_id, model, link_model, link_field, codes):
+    """
+    Link the records of a successful batch to its mutation log and record the per-item results
+    (code and uuid of each record, in the order of the input).
+    """
+    records = {}
+    for chunk in chunked(codes):
+        records.update(
+            (code, (record_id, str(record_uuid)))
+            for code, record_id, record_uuid in model.objects.filter(
+                code__in=chunk, *filter_validity()
+            ).values_list("code", "id", "uuid")
+        )
+    if not mutation_log_id:
+        return
+    link_model.objects.bulk_create(
+        [
+            link_model(**{f"{link_field}_id": record_id, "mutation_id": mutation_log_id})
+            for record_id, _uuid in records.values()
+        ]
+    )
+    update_mutation_log_ext(
+        mutation_log_id,
+        BATCH_RESULTS_KEY,
+        results=[{"code": code, "uuid": records[code][1]} for code in codes],
+    )
+
+
+def batch_errors(message, items, errors):
+    """Per-item error messages, errors being the (item number, detail) tuples returned by the importers"""
+    return [
+        {"message": message % {"code": items[line - 1].get("code")}, "detail": detail}
+        for line, detail in errors
+    ]
+
+
+class LocationBatchItemInputType(InputObjectType):
+    # existing location to update
+    uuid = graphene.String(required=False)
+    code = LocationCodeInputType(required=True)
+    name = graphene.String(required=True)
+    type = graphene.String(required=True)
+    male_population = graphene.Int(required=False)
+    female_population = graphene.Int(required=False)
+    other_population = graphene.Int(required=False)
+    families = graphene.Int(required=False)
+    # existing parent
+    parent_uuid = graphene.String(required=False)
+    # existing parent or parent created in the same batch
+    parent_code = graphene.String(required=False)
+
+
+class CreateLocationsMutation(OpenIMISMutation):
+    """
+    Create a batch of locations, and update the ones given with their uuid, in one transaction:
+    if any of them is rejected, none is saved.
+    The new locations are inserted in bulk, the updated ones go through LocationService.update_or_create.
+    """
+
+    _mutation_module = "location"
+    _mutation_class = "CreateLocationsMutation"
+
+    class Input(OpenIMISMutation.Input):
+        locations = graphene.List(LocationBatchItemInputType, required=True)
+
+    @classmethod
+    def async_mutate(cls, user, **data):
+        try:
+            mutation_log_id = data.pop("mutation_log_id", None)
+            if type(user) is AnonymousUser or not user.id:
+                raise ValidationError(_("mutation.authentication_required"))
+            if not user.has_perms(LocationConfig.gql_mutation_create_locations_perms):
+                raise PermissionDenied(_("unauthorized"))
+            items = data["locations"]
+            # item numbers (1 based, as the importer rows) of the locations to create and to update
+            created = [line for line, item in enumerate(items, start=1) if not item.get("uuid")]
+            updated = [line for line, item in enumerate(items, start=1) if item.get("uuid")]
+            if updated and not user.has_perms(LocationConfig.gql_mutation_edit_locations_perms):
+                raise PermissionDenied(_("unauthorized"))
+            parent_uuids = {item["parent_uuid"] for item in items if item.get("parent_uuid")}
+            parent_codes = {}
+            for chunk in chunked(parent_uuids):
+                parent_codes.update(
+                    Location.objects.filter(uuid__in=chunk, *filter_validity()).values_list(
+                        "uuid", "code"
+                    )
+                )
+            rows = [
+                {
+                    **items[line - 1],
+                    "parent_code": items[line - 1].get("parent_code")
+                    or parent_codes.get(items[line - 1].get("parent_uuid")),
+                }
+                for line in created
+            ]
+            # the caches are invalidated once, for the updates
+            with deferred_location_cache_invalidation(), transaction.atomic():
+                result = LocationImportService(user).import_locations(
+                    rows, all_or_nothing=True
+                )
+                errors = batch_errors(
+                    _("location.mutation.failed_to_create_location"),
+                    items,
+                    sorted((created[row - 1], detail) for row, detail in result["errors"]),
+                )
+                if not errors:
+                    errors = batch_errors(
+                        _("location.mutation.failed_to_update_location"),
+                        items,
+                        cls._update_locations(user, items, updated),
+                    )
+                if errors:
+                    transaction.set_rollback(True)
+                    return errors
+                record_batch_results(
+                    mutation_log_id,
+                    Location,
+                    LocationMutation,
+                    "location",
+                    [item["code"] for item in items],
+                )
+            return None
+        except Exception as exc:
+            return [
+                {
+                    "message": _("location.mutation.failed_to_create_locations"),
+                    "detail": str(exc),
+                }
+            ]
+
+    @staticmethod
+    def _update_locations(user, items, lines):
+        """:return: the (item number, detail) errors of the updates"""
+        from core.utils import TimeUtils
+
+        now = TimeUtils.now()
+        # the parents given by code may have been created by the batch
+        parent_codes = {items[line - 1]["parent_code"] for line in lines if items[line - 1].get("parent_code")}
+        parent_uuids = {}
+        for chunk in chunked(parent_codes):
+            parent_uuids.update(
+                Location.objects.filter(code__in=chunk, *filter_validity()).values_list("code", "uuid")
+            )
+        errors = []
+        service = LocationService(user)
+        for line in lines:
+            item = {**items[line - 1]}
+            parent_code = item.pop("parent_code", None)
+            if parent_code and not item.get("parent_uuid"):
+                if parent_code not in parent_uuids:
+                    errors.append((line, _("location.import.unknown_parent") % {"code": parent_code}))
+                    continue
+                item["parent_uuid"] = parent_uuids[parent_code]
+            try:
+                service.update_or_create({**item, "audit_user_id": user.id_for_audit, "validity_from": now})
+            except Exception as exc:
+                errors.append((line, str(exc)))
+        return errors
+
+
+class HealthFacilityBatchCatchmentInputType(InputObjectType):
+    location_code = graphene.String(required=True)
+    catchment = graphene.Int(required=False)
+
+
+class HealthFacilityBatchItemInputType(InputObjectType):
+    code = HealthFacilityCodeInputType(required=True)
+    name = graphene.String(required=True)
+    acc_code = graphene.String(required=False)
+    legal_form = graphene.String(required=True)
+    level = graphene.String(required=True)
+    sub_level = graphene.String(required=False)
+    location_code = graphene.String(required=True)
+    address = graphene.String(required=False)
+    phone = graphene.String(required=False)
+    fax = graphene.String(required=False)
+    email = graphene.String(required=False)
+    care_type = graphene.String(required=True)
+    services_pricelist = graphene.String(required=False)
+    items_pricelist = graphene.String(required=False)
+    offline = graphene.Boolean(required=False)
+    catchments = graphene.List(HealthFacilityBatchCatchmentInputType, required=False)
+    contract_start_date = graphene.Date(required=False)
+    contract_end_date = graphene.Date(required=False)
+    status = graphene.String(required=False)
+
+
+class CreateOrUpdateHealthFacilitiesMutation(OpenIMISMutation):
+    """
+    Create or update (matched on their code) a batch of health facilities and their catchments
+    in one transaction: if any of them is rejected, none is saved.
+    The references are given by code (legal form, sub level, locations) or name (price lists).
+    """
+
+    _mutation_module = "location"
+    _mutation_class = "CreateOrUpdateHealthFacilitiesMutation"
+
+    class Input(OpenIMISMutation.Input):
+        health_facilities = graphene.List(HealthFacilityBatchItemInputType, required=True)
+
+    @classmethod
+    def async_mutate(cls, user, **data):
+        try:
+            mutation_log_id = data.pop("mutation_log_id", None)
+            if type(user) is AnonymousUser or not user.id:
+                raise ValidationError(_("mutation.authentication_required"))
+            items = data["health_facilities"]
+            with transaction.atomic():
+                result = HealthFacilityImportService(user).import_health_facilities(
+                    items, all_or_nothing=True
+                )
+                if result["errors"]:
+                    return batch_errors(
+                        _("location.mutation.failed_to_update_health_facility"),
+                        items,
+                        result["errors"],
+                    )
+                record_batch_results(
+                    mutation_log_id,
+                    HealthFacility,
+                    HealthFacilityMutation,
+                    "health_facility",
+                    [item["code"] for item in items],
+                )
+            return None
+        except Exception as exc:
+            return [
+                {
+                    "message": _("location.mutation.failed_to_save_health_facilities"),
+                    "detail": str(exc),
+                }
+            ]
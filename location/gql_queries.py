@@ -129,6 +129,12 @@ class HealthFacilityGQLType(DjangoObjectType):
         )
 
 
+class CodeValidationGQLType(graphene.ObjectType):
+    code = graphene.String()
+    available = graphene.Boolean()
+    uuid = graphene.String(description="UUID of the valid record already using the code")
+
+
 class UserRegionGQLType(graphene.ObjectType):
     id = graphene.String()
     uuid = graphene.String()
@@ -164,6 +170,28 @@ class UserDistrictGQLType(graphene.ObjectType):
             self.parent = UserRegionGQLType(district.location.parent)
 
 
+class LocationAutocompleteGQLType(graphene.ObjectType):
+    id = graphene.String()
+    uuid = graphene.String()
+    code = graphene.String()
+    name = graphene.String()
+    type = graphene.String()
+    parent_id = graphene.String()
+
+    def __init__(self, location):
+        """
+        :param location: (id, uuid, code, name, type, parent_id) tuple from the autocomplete index
+        """
+        location_id, self.uuid, self.code, self.name, self.type, parent_id = location
+        self.id = str(
+            base64.b64encode(f"LocationGQLType:{location_id}".encode()), "utf-8"
+        )
+        if parent_id:
+            self.parent_id = str(
+                base64.b64encode(f"LocationGQLType:{parent_id}".encode()), "utf-8"
+            )
+
+
 class UserDistrictType(DjangoObjectType):
     class Meta:
         model = UserDistrict
@@ -0,0 +1,553 @@
+import csv
+import datetime
+import json
+import logging
+import uuid
+from itertools import islice
+
+from core import filter_validity
+from core.utils import TimeUtils
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.db import transaction
+from django.utils.translation import gettext as _
+
+from .apps import LocationConfig
+from .models import (
+    HealthFacility,
+    HealthFacilityCatchment,
+    HealthFacilityLegalForm,
+    HealthFacilitySubLevel,
+    Location,
+    UserDistrict,
+    bump_health_facility_version,
+    cache_location_graph,
+    chunked,
+    free_cache_for_health_facilities,
+    free_cache_for_user,
+    refresh_user_location_scope,
+)
+from .services import HealthFacilityService, LocationService
+
+logger = logging.getLogger(__name__)
+
+LOCATION_IMPORT_FIELDS = [
+    "code",
+    "name",
+    "type",
+    "parent_code",
+    "male_population",
+    "female_population",
+    "other_population",
+    "families",
+]
+LOCATION_IMPORT_INT_FIELDS = [
+    "male_population",
+    "female_population",
+    "other_population",
+    "families",
+]
+
+
+def read_csv_rows(stream):
+    """Stream the rows of a CSV file with a header line, as dicts"""
+    for row in csv.DictReader(stream):
+        yield {key.strip(): value.strip() if value else None for key, value in row.items() if key}
+
+
+def read_ndjson_rows(stream):
+    """Stream the rows of a JSON lines file (one JSON object per line), as dicts"""
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def read_rows(stream, file_format):
+    if file_format == "csv":
+        return read_csv_rows(stream)
+    if file_format in ("json", "ndjson", "jsonl"):
+        return read_ndjson_rows(stream)
+    raise ValueError(f"Unsupported import format: {file_format}")
+
+
+def _level(loc_type):
+    return LocationConfig.location_types.index(loc_type)
+
+
+def _to_int(value):
+    return int(value) if value not in (None, "") else None
+
+
+def _to_date(value):
+    if isinstance(value, str):
+        return datetime.date.fromisoformat(value) if value else None
+    return value
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes")
+    return bool(value)
+
+
+class LocationImportService:
+    """
+    Bulk import of a location hierarchy.
+    The rows are read in chunks, their parents are resolved by code against an in-memory map of the valid
+    locations and they are inserted level by level with bulk_create. A row whose parent appears later in the
+    stream waits for it. As bulk_create doesn't send any signal, the caches are refreshed once at the end.
+    """
+
+    def __init__(self, user, chunk_size=1000):
+        self.user = user
+        self.chunk_size = chunk_size
+
+    def import_locations(self, rows, dry_run=False, all_or_nothing=False):
+        """
+        :param rows: iterable of dicts with the LOCATION_IMPORT_FIELDS (parent_code is empty for the top level)
+        :param dry_run: validate and insert, then roll everything back
+        :param all_or_nothing: roll everything back if any row is rejected
+        :return: dict with the number of "created" (or, in dry run, creatable) locations
+                 and the "errors" as (row number, message) tuples
+        """
+        self.now = TimeUtils.now()
+        self.errors = []
+        self.created = 0
+        self.allowed_types = set()
+        # code > (id, type) of the valid locations, completed as the rows are inserted
+        self.known = {
+            code: (location_id, loc_type)
+            for code, location_id, loc_type in Location.objects.filter(
+                *filter_validity()
+            ).values_list("code", "id", "type")
+        }
+        # parent code > rows waiting for their parent to be inserted
+        self.pending = {}
+        self.new_districts = []
+        # parents of the inserted locations, the users seeing them see the new locations too
+        self.parent_ids = set()
+
+        with transaction.atomic():
+            rows = enumerate(rows, start=1)
+            while True:
+                chunk = list(islice(rows, self.chunk_size))
+                if not chunk:
+                    break
+                self._insert([r for r in map(self._validate, chunk) if r])
+            for waiting in self.pending.values():
+                self.errors.extend(
+                    (line, _("location.import.unknown_parent") % {"code": row["parent_code"]})
+                    for line, row in waiting
+                )
+            self._assign_new_districts()
+            rolled_back = dry_run or (all_or_nothing and bool(self.errors))
+            if rolled_back:
+                transaction.set_rollback(True)
+
+        logger.info(
+            "Location import%s: %s created, %s errors",
+            " (dry run)" if dry_run else "",
+            self.created,
+            len(self.errors),
+        )
+        if self.created and not rolled_back:
+            free_cache_for_user()
+            cache_location_graph()
+            if LocationConfig.location_user_scope_table:
+                refresh_user_location_scope(
+                    user_ids=[self.user.i_user.id] if self.new_districts and hasattr(self.user, "i_user") else [],
+                    location_ids=self.parent_ids,
+                )
+        return {"created": self.created, "errors": self.errors}
+
+    def _validate(self, numbered_row):
+        """:return: the numbered and cleaned row, or None if invalid (the error is recorded)"""
+        line, row = numbered_row
+        row = {field: row.get(field) or None for field in LOCATION_IMPORT_FIELDS}
+        try:
+            for field in LOCATION_IMPORT_INT_FIELDS:
+                row[field] = _to_int(row[field])
+        except ValueError as exc:
+            self.errors.append((line, str(exc)))
+            return None
+        code, loc_type = row["code"], row["type"]
+        if not code or not row["name"]:
+            self.errors.append((line, _("location.import.missing_code_or_name")))
+            return None
+        if loc_type not in LocationConfig.location_types:
+            self.errors.append((line, _("location.import.invalid_type") % {"type": loc_type}))
+            return None
+        if code in self.known:
+            self.errors.append((line, _("mutation.location_code_duplicated")))
+            return None
+        if loc_type not in self.allowed_types:
+            LocationService(self.user)._check_users_locations_rights(loc_type)
+            self.allowed_types.add(loc_type)
+        # reserve the code, the id will be set once inserted
+        self.known[code] = (None, loc_type)
+        return line, row
+
+    def _insert(self, numbered_rows):
+        """Insert the rows whose parent is known, level by level, then the rows that were waiting for them"""
+        levels = {}
+        for line, row in numbered_rows:
+            level = _level(row["type"])
+            parent_code = row["parent_code"]
+            if level == 0 and parent_code:
+                self.errors.append((line, _("location.import.unexpected_parent")))
+                self._release(row["code"])
+            elif level > 0 and not parent_code:
+                self.errors.append((line, _("location.import.missing_parent")))
+                self._release(row["code"])
+            elif parent_code and self.known.get(parent_code, (None,))[0] is None:
+                self.pending.setdefault(parent_code, []).append((line, row))
+            else:
+                levels.setdefault(level, []).append((line, row))
+
+        while levels:
+            level = min(levels)
+            inserted = self._insert_level(level, levels.pop(level))
+            for code in inserted:
+                for line, row in self.pending.pop(code, []):
+                    levels.setdefault(_level(row["type"]), []).append((line, row))
+
+    def _insert_level(self, level, numbered_rows):
+        locations = []
+        for line, row in numbered_rows:
+            parent_code = row.pop("parent_code")
+            parent = self.known.get(parent_code) if parent_code else None
+            if parent and _level(parent[1]) != level - 1:
+                self.errors.append(
+                    (line, _("location.import.invalid_parent_type") % {"code": parent_code})
+                )
+                self._release(row["code"])
+                continue
+            if parent:
+                self.parent_ids.add(parent[0])
+            locations.append(
+                Location(
+                    **row,
+                    parent_id=parent[0] if parent else None,
+                    validity_from=self.now,
+                    audit_user_id=self.user.id_for_audit,
+                )
+            )
+        Location.objects.bulk_create(locations, batch_size=self.chunk_size)
+
+        # bulk_create doesn't return the ids on every backend, fetch them back by code
+        codes = [location.code for location in locations]
+        for chunk in chunked(codes):
+            for code, location_id, loc_type in Location.objects.filter(
+                code__in=chunk, *filter_validity()
+            ).values_list("code", "id", "type"):
+                self.known[code] = (location_id, loc_type)
+                if loc_type == "D":
+                    self.new_districts.append(location_id)
+        self.created += len(locations)
+        return codes
+
+    def _release(self, code):
+        """Free the code reserved by a rejected row, its children will be reported as orphans"""
+        self.known.pop(code, None)
+
+    def _assign_new_districts(self):
+        """Bulk equivalent of LocationService._ensure_user_belongs_to_district"""
+        if not self.new_districts or not hasattr(self.user, "i_user"):
+            return
+        UserDistrict.objects.bulk_create(
+            [
+                UserDistrict(
+                    user=self.user.i_user,
+                    location_id=location_id,
+                    validity_from=self.now,
+                    audit_user_id=self.user.id_for_audit,
+                )
+                for location_id in self.new_districts
+            ],
+            batch_size=self.chunk_size,
+        )
+
+
+HEALTH_FACILITY_IMPORT_FIELDS = [
+    "code",
+    "name",
+    "acc_code",
+    "level",
+    "address",
+    "phone",
+    "fax",
+    "email",
+    "care_type",
+    "status",
+]
+# model fields written on update, on top of the imported ones
+HEALTH_FACILITY_UPDATE_FIELDS = HEALTH_FACILITY_IMPORT_FIELDS + [
+    "legal_form",
+    "sub_level",
+    "location",
+    "services_pricelist",
+    "items_pricelist",
+    "offline",
+    "contract_start_date",
+    "contract_end_date",
+    "validity_from",
+    "audit_user_id",
+]
+
+
+def _catchment_list(value):
+    """CSV files carry the catchments as a "LOCATION_CODE:catchment;..." column"""
+    if isinstance(value, str):
+        return [
+            dict(zip(("location_code", "catchment"), item.split(":", 1)))
+            for item in value.split(";")
+            if item.strip()
+        ]
+    return value or []
+
+
+class HealthFacilityImportService:
+    """
+    Bulk import of health facilities with their catchments, in a single transaction.
+    Facilities are matched on their code: new ones are created, existing ones are updated after a history
+    snapshot, like HealthFacilityService.update_or_create but with batched writes. The legal forms, sub levels,
+    price lists and locations are resolved against in-memory maps loaded once.
+    """
+
+    def __init__(self, user, chunk_size=1000):
+        self.user = user
+        self.chunk_size = chunk_size
+
+    def import_health_facilities(self, rows, dry_run=False, all_or_nothing=False):
+        """
+        :param rows: iterable of dicts with the HEALTH_FACILITY_IMPORT_FIELDS, plus legal_form and sub_level (codes),
+                     location_code, services_pricelist and items_pricelist (names), offline, contract_start_date,
+                     contract_end_date and catchments, a list of dicts with location_code and catchment
+                     (or a "LOCATION_CODE:catchment;..." string).
+        :param dry_run: validate and write, then roll everything back
+        :param all_or_nothing: roll everything back if any row is rejected
+        :return: dict with the number of "created" and "updated" facilities and the "errors" as
+                 (row number, message) tuples
+        """
+        if not self.user.has_perms(
+            LocationConfig.gql_mutation_create_health_facilities_perms
+        ) or not self.user.has_perms(LocationConfig.gql_mutation_edit_health_facilities_perms):
+            raise PermissionDenied(_("unauthorized"))
+        from medical_pricelist.models import ItemsPricelist, ServicesPricelist
+
+        self.now = TimeUtils.now()
+        self.errors = []
+        self.created = 0
+        self.updated = 0
+        self.moved_ids = []
+        self.updated_facilities = []
+        self.seen_codes = set()
+        self.legal_forms = set(HealthFacilityLegalForm.objects.values_list("code", flat=True))
+        self.sub_levels = set(HealthFacilitySubLevel.objects.values_list("code", flat=True))
+        self.services_pricelists = dict(
+            ServicesPricelist.objects.filter(*filter_validity()).values_list("name", "id")
+        )
+        self.items_pricelists = dict(
+            ItemsPricelist.objects.filter(*filter_validity()).values_list("name", "id")
+        )
+        self.locations = dict(
+            Location.objects.filter(*filter_validity()).values_list("code", "id")
+        )
+
+        with transaction.atomic():
+            rows = enumerate(rows, start=1)
+            while True:
+                chunk = list(islice(rows, self.chunk_size))
+                if not chunk:
+                    break
+                self._write([r for r in map(self._clean, chunk) if r])
+            rolled_back = dry_run or (all_or_nothing and bool(self.errors))
+            if rolled_back:
+                transaction.set_rollback(True)
+
+        logger.info(
+            "Health facility import%s: %s created, %s updated, %s errors",
+            " (dry run)" if dry_run else "",
+            self.created,
+            self.updated,
+            len(self.errors),
+        )
+        if (self.created or self.updated) and not rolled_back:
+            bump_health_facility_version()
+            # bulk_update skips save(), refresh the object cache it would have updated
+            HealthFacility.bulk_update_cache(self.updated_facilities)
+            # nor does it send the signals that evict the claim administrators of moved facilities
+            if self.moved_ids:
+                free_cache_for_health_facilities(self.moved_ids)
+        return {"created": self.created, "updated": self.updated, "errors": self.errors}
+
+    def _resolve(self, mapping, key, error):
+        if not key:
+            return None
+        if key not in mapping:
+            raise ValidationError(error % {"code": key})
+        return mapping[key] if isinstance(mapping, dict) else key
+
+    def _clean(self, numbered_row):
+        """:return: (line, model data, {catchment location id: catchment}), or None if invalid"""
+        line, row = numbered_row
+        try:
+            data = {field: row.get(field) or None for field in HEALTH_FACILITY_IMPORT_FIELDS}
+            if not all(data[field] for field in ("code", "name", "level", "care_type")):
+                raise ValidationError(_("health_facility.import.missing_mandatory_fields"))
+            if data["code"] in self.seen_codes:
+                raise ValidationError(_("mutation.hf_code_duplicated"))
+            if not data["status"]:
+                data["status"] = HealthFacility.HealthFacilityStatus.ACTIVE
+            unknown_reference = _("health_facility.import.unknown_reference")
+            data["legal_form_id"] = self._resolve(
+                self.legal_forms, row.get("legal_form"), unknown_reference
+            )
+            if not data["legal_form_id"]:
+                raise ValidationError(_("health_facility.import.missing_mandatory_fields"))
+            data["sub_level_id"] = self._resolve(
+                self.sub_levels, row.get("sub_level"), unknown_reference
+            )
+            data["location_id"] = self._resolve(
+                self.locations, row.get("location_code"), unknown_reference
+            )
+            if not data["location_id"]:
+                raise ValidationError(_("health_facility.import.missing_mandatory_fields"))
+            data["services_pricelist_id"] = self._resolve(
+                self.services_pricelists, row.get("services_pricelist"), unknown_reference
+            )
+            data["items_pricelist_id"] = self._resolve(
+                self.items_pricelists, row.get("items_pricelist"), unknown_reference
+            )
+            data["offline"] = _to_bool(row.get("offline"))
+            data["contract_start_date"] = _to_date(row.get("contract_start_date"))
+            data["contract_end_date"] = _to_date(row.get("contract_end_date"))
+            HealthFacilityService.validate_contract_and_status(data)
+            catchments = {
+                self._resolve(
+                    self.locations, c.get("location_code"), unknown_reference
+                ): _to_int(c.get("catchment"))
+                for c in _catchment_list(row.get("catchments"))
+            }
+        except ValidationError as exc:
+            self.errors.append((line, "; ".join(exc.messages)))
+            return None
+        except ValueError as exc:
+            self.errors.append((line, str(exc)))
+            return None
+        self.seen_codes.add(data["code"])
+        return line, data, catchments
+
+    def _write(self, cleaned_rows):
+        existing = {}
+        for codes in chunked([data["code"] for _line, data, _catchments in cleaned_rows]):
+            existing.update(
+                (hf.code, hf)
+                for hf in HealthFacility.objects.filter(code__in=codes, *filter_validity())
+            )
+
+        new_facilities = []
+        updated_facilities = []
+        histories = []
+        for _line, data, _catchments in cleaned_rows:
+            hf = existing.get(data["code"])
+            if hf is None:
+                new_facilities.append(
+                    HealthFacility(
+                        **data, validity_from=self.now, audit_user_id=self.user.id_for_audit
+                    )
+                )
+            else:
+                histories.append(self._history_copy(hf))
+                if hf.location_id != data["location_id"]:
+                    self.moved_ids.append(hf.id)
+                HealthFacilityService._reset_health_facility_before_update(hf)
+                [setattr(hf, key, data[key]) for key in data]
+                hf.validity_from = self.now
+                hf.audit_user_id = self.user.id_for_audit
+                updated_facilities.append(hf)
+
+        HealthFacility.objects.bulk_create(new_facilities + histories, batch_size=self.chunk_size)
+        HealthFacility.objects.bulk_update(
+            updated_facilities, HEALTH_FACILITY_UPDATE_FIELDS, batch_size=self.chunk_size
+        )
+        self.created += len(new_facilities)
+        self.updated += len(updated_facilities)
+        self.updated_facilities.extend(updated_facilities)
+
+        # bulk_create doesn't return the ids on every backend, fetch them back
+        ids_by_code = {}
+        for codes in chunked([hf.code for hf in new_facilities]):
+            ids_by_code.update(
+                HealthFacility.objects.filter(code__in=codes, *filter_validity()).values_list(
+                    "code", "id"
+                )
+            )
+        history_ids = {}
+        for uuids in chunked([h.uuid for h in histories]):
+            history_ids.update(
+                HealthFacility.objects.filter(uuid__in=uuids).values_list("legacy_id", "id")
+            )
+        ids_by_code.update((hf.code, hf.id) for hf in updated_facilities)
+
+        self._write_catchments(
+            {ids_by_code[data["code"]]: catchments for _line, data, catchments in cleaned_rows},
+            history_ids,
+        )
+
+    def _history_copy(self, hf):
+        """Bulk equivalent of save_history()"""
+        history = HealthFacility(
+            **{field.attname: getattr(hf, field.attname) for field in hf._meta.concrete_fields}
+        )
+        history.id = None
+        history.uuid = uuid.uuid4()
+        history.validity_to = self.now
+        history.legacy_id = hf.id
+        return history
+
+    def _write_catchments(self, catchments_by_hf, history_ids):
+        """
+        :param catchments_by_hf: {facility id: {location id: catchment}}, the complete catchments of each facility
+        :param history_ids: {updated facility id: id of its history snapshot}
+        """
+        current = {}
+        for hf_ids in chunked(history_ids.keys()):
+            for catchment in HealthFacilityCatchment.objects.filter(
+                health_facility_id__in=hf_ids, validity_to__isnull=True
+            ):
+                current.setdefault(catchment.health_facility_id, {})[
+                    catchment.location_id
+                ] = catchment
+
+        to_create = []
+        to_move = []
+        for hf_id, catchments in catchments_by_hf.items():
+            previous = current.get(hf_id, {})
+            for location_id, value in catchments.items():
+                prev_catchment = previous.pop(location_id, None)
+                if prev_catchment is not None and prev_catchment.catchment == value:
+                    continue
+                if prev_catchment is not None:
+                    # catchment has been updated, let's bind the old value to the history
+                    prev_catchment.health_facility_id = history_ids[hf_id]
+                    to_move.append(prev_catchment)
+                to_create.append(
+                    HealthFacilityCatchment(
+                        health_facility_id=hf_id,
+                        location_id=location_id,
+                        catchment=value,
+                        validity_from=self.now,
+                        audit_user_id=self.user.id_for_audit,
+                    )
+                )
+            # the remaining ones have been removed
+            for prev_catchment in previous.values():
+                prev_catchment.health_facility_id = history_ids[hf_id]
+                prev_catchment.validity_to = self.now
+                to_move.append(prev_catchment)
+
+        HealthFacilityCatchment.objects.bulk_update(
+            to_move, ["health_facility", "validity_to"], batch_size=self.chunk_size
+        )
+        HealthFacilityCatchment.objects.bulk_create(to_create, batch_size=self.chunk_size)
@@ -0,0 +1,29 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from location.exporters import export_lines
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream the valid location hierarchy (with the ancestor codes of each location) "
+        "or health facilities to a CSV or JSON lines file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--what", default="locations", choices=["locations", "health_facilities"]
+        )
+        parser.add_argument("--format", default="csv", choices=["csv", "ndjson"])
+        parser.add_argument(
+            "--output", help="path of the file to write, standard output by default"
+        )
+
+    def handle(self, *args, **options):
+        lines = export_lines(options["what"], options["format"])
+        if not options["output"]:
+            sys.stdout.writelines(lines)
+            return
+        with open(options["output"], "w", newline="", encoding="utf-8") as stream:
+            stream.writelines(lines)
@@ -0,0 +1,48 @@
+from core.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from location.importers import HealthFacilityImportService, read_rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk import (create or update by code) health facilities from a CSV (with header) or JSON lines file "
+        "with the columns code, name, acc_code, legal_form, level, sub_level, location_code, address, phone, fax, "
+        "email, care_type, status, services_pricelist, items_pricelist, offline, contract_start_date, "
+        "contract_end_date and catchments (list of {location_code, catchment} objects, "
+        "or LOCATION_CODE:catchment;... in CSV files)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="path of the file to import")
+        parser.add_argument(
+            "--username", required=True, help="user performing the import"
+        )
+        parser.add_argument(
+            "--format", default="csv", choices=["csv", "json", "ndjson", "jsonl"]
+        )
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="validate the file and roll back the import",
+        )
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options["username"]).first()
+        if user is None:
+            raise CommandError(f"Unknown user {options['username']}")
+        with open(options["file"], newline="", encoding="utf-8-sig") as stream:
+            result = HealthFacilityImportService(
+                user, chunk_size=options["chunk_size"]
+            ).import_health_facilities(
+                read_rows(stream, options["format"]), dry_run=options["dry_run"]
+            )
+        for line, message in result["errors"]:
+            self.stderr.write(f"row {line}: {message}")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{result['created']} health facilities created, {result['updated']} updated"
+                f"{' (dry run)' if options['dry_run'] else ''}, {len(result['errors'])} errors"
+            )
+        )
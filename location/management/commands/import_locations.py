@@ -0,0 +1,45 @@
+from core.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from location.importers import LocationImportService, read_rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk import a location hierarchy from a CSV (with header) or JSON lines file with the columns "
+        "code, name, type, parent_code, male_population, female_population, other_population, families."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="path of the file to import")
+        parser.add_argument(
+            "--username", required=True, help="user performing the import"
+        )
+        parser.add_argument(
+            "--format", default="csv", choices=["csv", "json", "ndjson", "jsonl"]
+        )
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="validate the file and roll back the import",
+        )
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options["username"]).first()
+        if user is None:
+            raise CommandError(f"Unknown user {options['username']}")
+        with open(options["file"], newline="", encoding="utf-8-sig") as stream:
+            result = LocationImportService(
+                user, chunk_size=options["chunk_size"]
+            ).import_locations(
+                read_rows(stream, options["format"]), dry_run=options["dry_run"]
+            )
+        for line, message in result["errors"]:
+            self.stderr.write(f"row {line}: {message}")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{result['created']} locations {'validated' if options['dry_run'] else 'created'}, "
+                f"{len(result['errors'])} errors"
+            )
+        )
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from location.models import rebuild_user_location_scope
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the user_location_scope table (locations each interactive user can see) "
+        "from the user districts and location tree."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = rebuild_user_location_scope(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Scope of {count} users rebuilt"))
@@ -0,0 +1,73 @@
+import logging
+
+from django.conf import settings
+from django.db import DatabaseError, migrations, transaction
+
+logger = logging.getLogger(__name__)
+
+# PostgreSQL: trigram indexes matching the UPPER(...) LIKE UPPER('%...%') generated by icontains lookups
+# MSSQL: plain indexes on the searched columns
+SEARCH_INDEXES = [
+    ("ix_tblLocations_code_search", "tblLocations", "LocationCode"),
+    ("ix_tblLocations_name_search", "tblLocations", "LocationName"),
+    ("ix_tblHF_code_search", "tblHF", "HFCode"),
+    ("ix_tblHF_name_search", "tblHF", "HFName"),
+]
+
+
+def _create_index_sql(name, table, column):
+    if settings.MSSQL:
+        return f"CREATE NONCLUSTERED INDEX {name} ON [dbo].[{table}] ([{column}] ASC)"
+    return (
+        f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" '
+        f'USING gin (UPPER("{column}"::text) gin_trgm_ops)'
+    )
+
+
+def _drop_index_sql(name, table, column):
+    if settings.MSSQL:
+        return f"DROP INDEX {name} ON [dbo].[{table}]"
+    return f'DROP INDEX IF EXISTS "{name}"'
+
+
+def _trigram_available(schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        if cursor.fetchone():
+            return True
+    # creating the extension requires a privileged role, which the deployment may not have
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except DatabaseError as exc:
+        logger.warning(
+            "pg_trgm extension not available (%s), the location search indexes are not created. "
+            "Run CREATE EXTENSION pg_trgm as a superuser and migrate location back to 0018 then forward "
+            "to create them.",
+            exc,
+        )
+        return False
+    return True
+
+
+def create_search_indexes(apps, schema_editor):
+    if not settings.MSSQL and not _trigram_available(schema_editor):
+        return
+    for index in SEARCH_INDEXES:
+        schema_editor.execute(_create_index_sql(*index))
+
+
+def drop_search_indexes(apps, schema_editor):
+    for index in SEARCH_INDEXES:
+        schema_editor.execute(_drop_index_sql(*index))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("location", "0018_auto_20230925_2243"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
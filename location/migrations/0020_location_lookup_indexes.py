@@ -0,0 +1,69 @@
+from django.conf import settings
+from django.db import migrations
+
+# (name, table, columns, live rows only)
+# Partial (filtered) indexes are only used where every query filters on "ValidityTo" IS NULL:
+# the recursive CTEs join on ParentLocationId without any validity filter and the catchments
+# are also read with their history.
+LOOKUP_INDEXES = [
+    ("ix_tblLocations_parent_validity", "tblLocations", ["ParentLocationId", "ValidityTo"], False),
+    ("ix_tblLocations_type_live", "tblLocations", ["LocationType"], True),
+    ("ix_tblLocations_code_validity", "tblLocations", ["LocationCode", "ValidityTo"], False),
+    ("ix_tblHF_location_live", "tblHF", ["LocationId"], True),
+    ("ix_tblHF_code_validity", "tblHF", ["HFCode", "ValidityTo"], False),
+    ("ix_tblUsersDistricts_user_live", "tblUsersDistricts", ["UserID"], True),
+    ("ix_tblHFCatchment_hf_validity", "tblHFCatchment", ["HFID", "ValidityTo"], False),
+]
+
+
+def _quote(name):
+    return f"[{name}]" if settings.MSSQL else f'"{name}"'
+
+
+def _create_index_sql(name, table, columns, live_only):
+    return (
+        f"CREATE {'NONCLUSTERED ' if settings.MSSQL else ''}INDEX {_quote(name)} "
+        f"ON {_quote(table)} ({', '.join(_quote(c) + ' ASC' for c in columns)})"
+        f"{' WHERE ' + _quote('ValidityTo') + ' IS NULL' if live_only else ''}"
+    )
+
+
+def _drop_index_sql(name, table, *args):
+    if settings.MSSQL:
+        return f"DROP INDEX IF EXISTS {_quote(name)} ON {_quote(table)}"
+    return f"DROP INDEX IF EXISTS {_quote(name)}"
+
+
+def _create_missing_index_sql(name, table, *args):
+    # the legacy index may not exist in every database: only recreate it where it is missing
+    if settings.MSSQL:
+        return (
+            f"IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = '{name}' AND object_id = OBJECT_ID('{table}')) "
+            + _create_index_sql(name, table, *args)
+        )
+    return _create_index_sql(name, table, *args).replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS", 1)
+
+
+# superseded by ix_tblLocations_parent_validity
+PARENT_LEGACY_INDEX = (
+    "ix_tblLocation_parentLocationId",
+    "tblLocations",
+    ["ParentLocationId", "LegacyID"],
+    False,
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("location", "0019_location_search_indexes"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            [_create_index_sql(*index) for index in LOOKUP_INDEXES]
+            + [_drop_index_sql(*PARENT_LEGACY_INDEX)],
+            reverse_sql=[_create_missing_index_sql(*PARENT_LEGACY_INDEX)]
+            + [_drop_index_sql(*index) for index in LOOKUP_INDEXES],
+        )
+    ]
@@ -0,0 +1,63 @@
+from django.conf import settings
+from django.db import migrations
+
+# (name, table, column): only one live (ValidityTo IS NULL) row per code
+CODE_UNIQUE_INDEXES = [
+    ("ux_tblLocations_code_live", "tblLocations", "LocationCode"),
+    ("ux_tblHF_code_live", "tblHF", "HFCode"),
+]
+
+
+def _create_index_sql(name, table, column):
+    if settings.MSSQL:
+        # unlike PostgreSQL, MSSQL considers NULLs as equal in unique indexes
+        return (
+            f"CREATE UNIQUE NONCLUSTERED INDEX [{name}] ON [{table}] ([{column}] ASC) "
+            f"WHERE [ValidityTo] IS NULL AND [{column}] IS NOT NULL"
+        )
+    return (
+        f'CREATE UNIQUE INDEX "{name}" ON "{table}" ("{column}" ASC) '
+        f'WHERE "ValidityTo" IS NULL'
+    )
+
+
+def check_no_duplicate_live_codes(apps, schema_editor):
+    """Fail with the duplicated codes to fix, rather than with the raw error of the index creation"""
+    quote = schema_editor.quote_name
+    duplicates = {}
+    with schema_editor.connection.cursor() as cursor:
+        for _name, table, column in CODE_UNIQUE_INDEXES:
+            cursor.execute(
+                f"SELECT {quote(column)} FROM {quote(table)} WHERE {quote('ValidityTo')} IS NULL "
+                f"AND {quote(column)} IS NOT NULL GROUP BY {quote(column)} HAVING COUNT(*) > 1"
+            )
+            codes = [code for code, in cursor.fetchall()]
+            if codes:
+                duplicates[table] = codes
+    if duplicates:
+        raise RuntimeError(
+            "Several live (ValidityTo IS NULL) records share the same code, close or recode the duplicates "
+            "before migrating: "
+            + "; ".join(f"{table}: {', '.join(codes)}" for table, codes in duplicates.items())
+        )
+
+
+def _drop_index_sql(name, table, column):
+    if settings.MSSQL:
+        return f"DROP INDEX IF EXISTS [{name}] ON [{table}]"
+    return f'DROP INDEX IF EXISTS "{name}"'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("location", "0020_location_lookup_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(check_no_duplicate_live_codes, migrations.RunPython.noop),
+        migrations.RunSQL(
+            [_create_index_sql(*index) for index in CODE_UNIQUE_INDEXES],
+            reverse_sql=[_drop_index_sql(*index) for index in CODE_UNIQUE_INDEXES],
+        )
+    ]
@@ -0,0 +1,59 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0019_extended_field"),
+        ("location", "0021_live_code_unique_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserLocationScope",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                (
+                    "type",
+                    models.CharField(db_column="LocationType", max_length=1),
+                ),
+                (
+                    "location",
+                    models.ForeignKey(
+                        db_column="LocationId",
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="+",
+                        to="location.location",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        db_column="UserID",
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="+",
+                        to="core.interactiveuser",
+                    ),
+                ),
+            ],
+            options={
+                "db_table": "user_location_scope",
+                "managed": True,
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="userlocationscope",
+            constraint=models.UniqueConstraint(
+                fields=("user", "location"), name="ux_user_location_scope"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="userlocationscope",
+            index=models.Index(
+                fields=["location", "user"], name="ix_user_location_scope_loc"
+            ),
+        ),
+    ]
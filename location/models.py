@@ -1,9 +1,14 @@
 from functools import reduce
 import django
 from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django_redis.cache import RedisCache
+import threading
 import uuid
+from contextlib import contextmanager
+from copy import deepcopy
 from core import filter_validity
+from django.apps import apps
 from django.conf import settings
 from django.db import models, connection
 from django.dispatch import receiver
@@ -20,15 +25,29 @@ logger = logging.getLogger(__file__)
 cache = caches["location"]
 
 
+USER_CACHE_PREFIXES = ["user_locations_", "user_districts_", "user_scope_"]
+
+
 def free_cache_for_user(user_id="*"):
     # wildcard only supported for Redis
-    if user_id == "*" and not isinstance(cache, RedisCache):
-        cache.clear()
+    if user_id == "*":
+        if isinstance(cache, RedisCache):
+            for prefix in USER_CACHE_PREFIXES:
+                cache.delete_pattern(f"{prefix}*")
+        else:
+            cache.clear()
     else:
-        cache_name = f"user_locations_{user_id}"
-        cache.delete(cache_name)
-        cache_name = f"user_districts_{user_id}"
-        cache.delete(cache_name)
+        cache.delete_many([f"{prefix}{user_id}" for prefix in USER_CACHE_PREFIXES])
+
+
+def free_cache_for_login_names(login_names):
+    """Evict the cached locations of the interactive users logging in as these officers/claim admins"""
+    user_ids = core_models.InteractiveUser.objects.filter(
+        login_name__in=login_names
+    ).values_list("id", flat=True)
+    cache.delete_many(
+        [f"{prefix}{user_id}" for user_id in user_ids for prefix in USER_CACHE_PREFIXES]
+    )
 
 
 @receiver(post_save, sender=core_models.InteractiveUser)
@@ -37,18 +56,47 @@ def free_cache_post_user_save(sender, instance, **kwargs):
     free_cache_for_user(instance.id)
 
 
+# MSSQL supports at most 2100 parameters per query
+MAX_QUERY_PARAMS = 2000
+
+
+def chunked(values, size=MAX_QUERY_PARAMS):
+    """Split values in lists small enough to be bound as query parameters"""
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
 class LocationManager(models.Manager):
-    def parents(self, location_id, loc_type=None):
-        parents = Location.objects.raw(
-            f"""
-            WITH {"" if settings.MSSQL else "RECURSIVE"} CTE_PARENTS AS (
+    def parents(self, location_id, loc_type=None, from_cache=False, values_only=False):
+        """
+        Retrieve the given locations and all their ancestors.
+        :param location_id: a location id or a list of location ids
+        :param loc_type: only return the locations of this type
+        :param from_cache: resolve the ancestors in the cached location tree instead of a recursive query
+        :param values_only: return the list of the location ids instead of a queryset
+        :return: queryset of the locations (raw queryset on MSSQL) or list of ids
+        """
+        location_ids = self._as_id_list(location_id)
+        if from_cache:
+            parents_map = get_location_tree()["parents"]
+            result_ids = set()
+            for current in location_ids:
+                while current in parents_map and current not in result_ids:
+                    result_ids.add(current)
+                    current = parents_map[current]
+            locations = self._from_ids(result_ids, loc_type, values_only)
+            if locations is not None:
+                return locations
+        return self._recursive_query(
+            """
             SELECT
                 "LocationId",
                 "LocationType",
                 "ParentLocationId"
             FROM
                 "tblLocations"
-            WHERE "LocationId" in ( %s )
+            WHERE "LocationId" in ( {ids} )
             UNION ALL
 
             SELECT
@@ -57,36 +105,119 @@ class LocationManager(models.Manager):
                 parent."ParentLocationId"
             FROM
                 "tblLocations" parent
-                INNER JOIN CTE_PARENTS leaf
+                INNER JOIN CTE_LOCATIONS leaf
                     ON parent."LocationId" = leaf."ParentLocationId"
-            )
-            SELECT * FROM CTE_PARENTS;
-        """,
-            (
-                (
-                    ",".join(map(str, location_id))
-                    if isinstance(location_id, list)
-                    else location_id
-                ),
-            ),
+            """,
+            location_ids,
+            loc_type,
+            values_only=values_only,
         )
-        return self.get_location_from_ids((parents), loc_type) if loc_type else parents
 
+    @staticmethod
+    def _as_id_list(location_id):
+        if isinstance(location_id, (list, tuple, set)):
+            return list(dict.fromkeys(location_id))
+        return [location_id]
+
+    def _recursive_query(
+        self, cte_sql, location_ids, loc_type, params=(), values_only=False
+    ):
+        """
+        Run a recursive CTE named CTE_LOCATIONS seeded by chunks of location ids.
+        :param cte_sql: body of the CTE, with an {ids} placeholder for the seed ids
+        :param params: additional parameters following the seed ids in the CTE body
+        :param values_only: return the list of the location ids instead of a queryset
+        """
 
-    def allowed(self, user_id, loc_types=["R", "D", "W", "V"], strict=True, qs=False):
-        strict_sql = """
-        AND (
-            SELECT COUNT(*) FROM USER_LOC  ul
-            WHERE ul."ParentLocationId" = parent."LocationId" ) =  (
-                SELECT COUNT(*) FROM "tblLocations" l
-                WHERE l."ParentLocationId" = parent."LocationId" AND l."ValidityTo" is Null
-            )
+        def build_query(chunk, full_rows=False):
+            type_filter = '"LocationType" = %s' if loc_type else ""
+            if full_rows:
+                select = f"""SELECT * FROM "tblLocations"
+                    WHERE "LocationId" in (SELECT "LocationId" FROM CTE_LOCATIONS)
+                    {"AND " + type_filter if loc_type else ""}"""
+            else:
+                select = f"""SELECT DISTINCT "LocationId" FROM CTE_LOCATIONS
+                    {"WHERE " + type_filter if loc_type else ""}"""
+            query = f"""
+                WITH {"" if settings.MSSQL else "RECURSIVE"} CTE_LOCATIONS AS (
+                {cte_sql.format(ids=", ".join(["%s"] * len(chunk)))}
+                )
+                {select}
+            """
+            return query, [*chunk, *params, *([loc_type] if loc_type else [])]
+
+        if not values_only and len(location_ids) <= MAX_QUERY_PARAMS:
+            # a single query, only binding the given ids
+            if settings.MSSQL:
+                # MSSQL doesn't support WITH in subqueries
+                return Location.objects.raw(*build_query(location_ids, full_rows=True))
+            return Location.objects.filter(id__in=RawSQL(*build_query(location_ids)))
+        result = set()
+        with connection.cursor() as cursor:
+            for chunk in chunked(location_ids):
+                cursor.execute(*build_query(chunk))
+                result.update(x for x, in cursor.fetchall())
+        if values_only:
+            return list(result)
+        if self._bindable(result):
+            return Location.objects.filter(id__in=list(result))
+        # more ids than MSSQL can bind in a query, even as seeds: the locations are loaded per chunk
+        return [location for chunk in chunked(result) for location in Location.objects.filter(id__in=chunk)]
+
+    @staticmethod
+    def _bindable(location_ids):
+        """MSSQL doesn't accept more than 2100 parameters per query"""
+        return not settings.MSSQL or len(location_ids) <= MAX_QUERY_PARAMS
+
+    def _from_ids(self, location_ids, loc_type=None, values_only=False):
+        """
+        :return: the locations of loc_type among location_ids, as a queryset (or list of ids),
+            None if there are too many of them to bind in a query
         """
+        if loc_type:
+            location_ids = set(location_ids) & get_location_tree()["types"].get(
+                loc_type, set()
+            )
+        if values_only:
+            return list(location_ids)
+        if not self._bindable(location_ids):
+            return None
+        return Location.objects.filter(id__in=list(location_ids))
+
+    def allowed(self, user_id, loc_types=["R", "D", "W", "V"], strict=True, qs=False):
+        # The valid locations of the UserDistricts, their valid descendants and their fully covered parents.
+        # A parent is "fully covered" when all its valid children are user locations. The counts are
+        # computed once per parent with grouped aggregates instead of correlated subqueries per candidate row.
+        scope_parents_sql = (
+            """
+            COVERED_PARENTS AS (
+                SELECT covered."ParentLocationId" AS "LocationId"
+                FROM (
+                    SELECT "ParentLocationId", COUNT(*) AS "Covered" FROM USER_LOC
+                    WHERE "ParentLocationId" IS NOT NULL
+                    GROUP BY "ParentLocationId"
+                ) covered
+                JOIN (
+                    SELECT l."ParentLocationId", COUNT(*) AS "Total" FROM "tblLocations" l
+                    WHERE l."ValidityTo" is Null
+                    AND l."ParentLocationId" in (SELECT "ParentLocationId" FROM USER_LOC)
+                    GROUP BY l."ParentLocationId"
+                ) total
+                    ON total."ParentLocationId" = covered."ParentLocationId"
+                    AND total."Total" = covered."Covered"
+            ),"""
+            if strict
+            else """
+            COVERED_PARENTS AS (
+                SELECT "ParentLocationId" AS "LocationId" FROM USER_LOC
+            ),"""
+        )
         query = f"""
             WITH {"" if settings.MSSQL else "RECURSIVE"} USER_LOC AS
                 (SELECT l."LocationId", l."ParentLocationId" FROM "tblUsersDistricts" ud
                 JOIN "tblLocations" l ON ud."LocationId" = l."LocationId"
-                WHERE ud."ValidityTo"  is Null AND "UserID" = %s ),
+                WHERE ud."ValidityTo"  is Null AND l."ValidityTo" is Null AND "UserID" = %s ),
+            {scope_parents_sql}
              CTE_PARENTS AS (
             SELECT
                 parent."LocationId",
@@ -95,10 +226,10 @@ class LocationManager(models.Manager):
 
             FROM
                 "tblLocations" parent
-            WHERE "LocationId" in (SELECT "LocationId" FROM USER_LOC)
-            OR (  parent."LocationId" in  (SELECT "ParentLocationId" FROM USER_LOC)
-                    {
-                        strict_sql if strict else ""})
+            WHERE parent."ValidityTo" is Null AND (
+                "LocationId" in (SELECT "LocationId" FROM USER_LOC)
+                OR parent."LocationId" in (SELECT "LocationId" FROM COVERED_PARENTS)
+            )
             UNION ALL
             SELECT
                 child."LocationId",
@@ -108,12 +239,21 @@ class LocationManager(models.Manager):
                 "tblLocations"  child
                 INNER JOIN CTE_PARENTS leaf
                     ON child."ParentLocationId" = leaf."LocationId"
+            WHERE child."ValidityTo" is Null
             )
             SELECT DISTINCT "LocationId" FROM CTE_PARENTS WHERE "LocationType" in ('{"','".join(loc_types)}')
         """
 
         if qs is not None:
-            if settings.MSSQL:  # MSSQL don't support WITH in subqueries
+            if settings.MSSQL and strict and LocationConfig.location_user_scope_table:
+                # MSSQL doesn't support WITH in subqueries: join the precomputed scope instead
+                # of binding every id as a parameter (limited to 2100 per query)
+                location_allowed = Location.objects.filter(
+                    id__in=UserLocationScope.objects.filter(
+                        user_id=user_id, type__in=loc_types
+                    ).values("location_id")
+                )
+            elif settings.MSSQL:  # MSSQL don't support WITH in subqueries
 
                 with connection.cursor() as cursor:
                     cursor.execute(query, (user_id,))
@@ -129,42 +269,79 @@ class LocationManager(models.Manager):
 
         return location_allowed
 
-    def children(self, location_id, loc_type=None):
-        children = Location.objects.raw(
+    def children(
+        self,
+        location_id,
+        loc_type=None,
+        from_cache=False,
+        max_depth=None,
+        values_only=False,
+    ):
+        """
+        Retrieve the given locations and all their descendants.
+        The traversal doesn't go below the locations of loc_type nor beyond max_depth, so asking for the districts
+        of a region doesn't walk through its wards and villages.
+        :param location_id: a location id or a list of location ids
+        :param loc_type: only return the locations of this type
+        :param from_cache: resolve the descendants in the cached location tree instead of a recursive query
+        :param max_depth: number of levels to go down, 0 only returns the given locations
+        :param values_only: return the list of the location ids instead of a queryset
+        :return: queryset of the locations (raw queryset on MSSQL) or list of ids
+        """
+        location_ids = self._as_id_list(location_id)
+        if from_cache:
+            tree = get_location_tree()
+            leaves = tree["types"].get(loc_type, set()) if loc_type else set()
+            result_ids = set(location_ids)
+            level = set(location_ids)
+            depth = 0
+            while level and (max_depth is None or depth < max_depth):
+                level = {
+                    child
+                    for current in level - leaves
+                    for child in tree["graph"].get(current, set())
+                } - result_ids
+                result_ids.update(level)
+                depth += 1
+            locations = self._from_ids(result_ids, loc_type, values_only)
+            if locations is not None:
+                return locations
+
+        conditions = []
+        params = []
+        if max_depth is not None:
+            conditions.append('parent."Level" < %s')
+            params.append(max_depth)
+        if loc_type:
+            conditions.append('parent."LocationType" <> %s')
+            params.append(loc_type)
+        return self._recursive_query(
             f"""
-                WITH {"" if settings.MSSQL else "RECURSIVE"} CTE_CHILDREN AS (
-                SELECT
-                    "LocationId",
-                    "LocationType",
-                    "ParentLocationId",
-                    0 as "Level"
-                FROM
-                    "tblLocations"
-                WHERE "LocationId" in ( %s )
-                UNION ALL
-
-                SELECT
-                    child."LocationId",
-                    child."LocationType",
-                    child."ParentLocationId",
-                    parent."Level" + 1 as "Level"
-                FROM
-                    "tblLocations" child
-                    INNER JOIN CTE_CHILDREN parent
-                        ON child."ParentLocationId" = parent."LocationId"
-                )
-                SELECT * FROM CTE_CHILDREN;
+            SELECT
+                "LocationId",
+                "LocationType",
+                "ParentLocationId",
+                0 as "Level"
+            FROM
+                "tblLocations"
+            WHERE "LocationId" in ( {{ids}} )
+            UNION ALL
+
+            SELECT
+                child."LocationId",
+                child."LocationType",
+                child."ParentLocationId",
+                parent."Level" + 1 as "Level"
+            FROM
+                "tblLocations" child
+                INNER JOIN CTE_LOCATIONS parent
+                    ON child."ParentLocationId" = parent."LocationId"
+            {"WHERE " + " AND ".join(conditions) if conditions else ""}
             """,
-            (
-                (
-                    ",".join(map(str, location_id))
-                    if isinstance(location_id, list)
-                    else location_id
-                ),
-            ),
-        )
-        return (
-            self.get_location_from_ids((children), loc_type) if loc_type else children
+            location_ids,
+            loc_type,
+            params=params,
+            values_only=values_only,
         )
 
     def build_user_location_filter_query(
@@ -174,14 +351,19 @@ class LocationManager(models.Manager):
         queryset=None,
         loc_types=["R", "D", "W", "V"],
     ):
-        q_allowed_location = None
+        """
+        Restrict a queryset (or build the Q to do so) to the records located where the user can see.
+        Nothing is filtered when ROW_SECURITY is off or for superusers.
+        """
+        if not settings.ROW_SECURITY or user.is_superuser:
+            return queryset if queryset is not None else Q()
         if not isinstance(user, core_models.InteractiveUser):
             logger.warning(f"Access without filter for user {user.id} ")
             if queryset is not None:
                 return queryset
             else:
                 return Q()
-        elif not user.is_superuser:
+        else:
             q_allowed_location = Q(
                 (
                     f"{prefix}__in",
@@ -194,16 +376,6 @@ class LocationManager(models.Manager):
                 return queryset.filter(q_allowed_location)
             else:
                 return q_allowed_location
-        else:
-            if queryset is not None:
-                return queryset
-            else:
-                return Q()
-
-    def get_location_from_ids(self, qsr, loc_type):
-        if loc_type:
-            return [x for x in list(qsr) if x.type == loc_type]
-        return list(qsr)
 
     def get_allowed_ids(self, user, strict=True):
         if hasattr(user, "_u"):
@@ -230,6 +402,96 @@ class LocationManager(models.Manager):
             cache.set(cache_name, allowed, None)
         return allowed
 
+    def get_user_scope(self, user):
+        """
+        Ids of the valid locations the user can see, the same as Location.get_queryset: the officer and
+        claim administrator scopes, or the UserDistrict locations, their descendants and fully covered parents.
+        The result is cached per user for the current location tree version.
+        :param user: core User (or InteractiveUser)
+        :return: set of location ids, None if the user is not restricted
+        """
+        if not settings.ROW_SECURITY or user.is_superuser:
+            return None
+        if user.is_anonymous:
+            return set()
+        if user.has_perms(LocationConfig.gql_mutation_create_region_locations_perms):
+            return None
+        if hasattr(user, "_u"):
+            user = user._u
+        if user.is_officer:
+            return self.get_officer_scope(user.username, login_only=True)
+        if user.is_claim_admin:
+            return self.get_claim_admin_scope(user.username)
+        version = get_location_tree_version()
+        cache_name = f"user_scope_{user.id}"
+        scope = cache.get(cache_name)
+        if scope is None or scope["version"] != version:
+            tree = get_location_tree()
+            sources = UserDistrict.objects.filter(user_id=user.id, *filter_validity()).values_list(
+                "location_id", flat=True
+            )
+            scope = {
+                "version": tree["version"],
+                "ids": set(compute_user_location_scope(sources, tree)),
+            }
+            cache.set(cache_name, scope, None)
+        return scope["ids"]
+
+    def get_officer_scope(self, officer_code, login_only=False):
+        """
+        Ids of the locations an enrolment officer can see: his villages and their ancestors
+        (as Officer.officer_allowed_locations), cached per officer for the current location tree version.
+        :param login_only: as the scope of the officer's user, empty if the officer has no login
+        """
+        version = get_location_tree_version()
+        cache_name = f"officer_scope_{officer_code}"
+        scope = cache.get(cache_name)
+        if scope is None or scope["version"] != version:
+            tree = get_location_tree()
+            ids = set()
+            has_login = False
+            for location_id, officer_has_login in OfficerVillage.objects.filter(
+                officer__code=officer_code,
+                *filter_validity(),
+                *filter_validity(prefix="officer__"),
+            ).values_list("location_id", "officer__has_login"):
+                has_login = has_login or bool(officer_has_login)
+                while location_id is not None and location_id not in ids:
+                    ids.add(location_id)
+                    location_id = tree["parents"].get(location_id)
+            scope = {"version": tree["version"], "ids": ids, "has_login": has_login}
+            cache.set(cache_name, scope, None)
+        if login_only and not scope.get("has_login"):
+            return set()
+        return scope["ids"]
+
+    def get_claim_admin_scope(self, claim_admin_code):
+        """
+        Ids of the locations a claim administrator can see: the district of his health facility, its region
+        and its descendants (as ClaimAdmin.officer_allowed_locations), cached per claim administrator for
+        the current location tree version.
+        """
+        from claim.models import ClaimAdmin
+
+        version = get_location_tree_version()
+        cache_name = f"claim_admin_scope_{claim_admin_code}"
+        scope = cache.get(cache_name)
+        if scope is None or scope["version"] != version:
+            tree = get_location_tree()
+            district_id = (
+                ClaimAdmin.objects.filter(code=claim_admin_code, *filter_validity())
+                .values_list("health_facility__location_id", flat=True)
+                .first()
+            )
+            ids = set()
+            if district_id:
+                ids = extend_allowed_locations([district_id], True)
+                if tree["parents"].get(district_id):
+                    ids.add(tree["parents"][district_id])
+            scope = {"version": tree["version"], "ids": ids}
+            cache.set(cache_name, scope, None)
+        return scope["ids"]
+
     def is_allowed(self, user, locations_id, strict=True):
         if user.is_superuser or not settings.ROW_SECURITY:
             return True
@@ -239,22 +501,75 @@ class LocationManager(models.Manager):
         )
 
 
+LOCATION_TREE_CACHE_KEY = "location_tree"
+LOCATION_TREE_VERSION_CACHE_KEY = "location_tree_version"
+
+
 def cache_location_graph():
-    """Cache the location graph as a dictionary of edges."""
-    locations = Location.objects.filter(*filter_validity())
+    """
+    Cache the location graph (edges) and the location types as one versioned snapshot.
+    Both structures are stored under a single key so that a partial eviction can never
+    leave the graph and the types out of sync.
+    :return: the cached snapshot
+    """
+    locations = Location.objects.filter(*filter_validity()).values_list(
+        "id", "parent_id", "type"
+    )
     graph = {}
+    parents = {}
     location_types = {}
-    for location in locations:
-        parent_id = location.parent_id if location.parent_id else "root"
-        if parent_id not in graph:
-            graph[parent_id] = set()
-        graph[parent_id].add(location.id)
-        if location.type not in location_types:
-            location_types[location.type] = set()
-        location_types[location.type].add(location.id)
+    for location_id, parent_id, location_type in locations:
+        graph.setdefault(parent_id if parent_id else "root", set()).add(location_id)
+        parents[location_id] = parent_id
+        location_types.setdefault(location_type, set()).add(location_id)
+
+    tree = {
+        "version": uuid.uuid4().hex,
+        "graph": graph,
+        "parents": parents,
+        "types": location_types,
+    }
+    cache.set(LOCATION_TREE_CACHE_KEY, tree, timeout=None)  # Cache indefinitely
+    # the version alone, for the caches derived from the tree to check they are up to date cheaply
+    cache.set(LOCATION_TREE_VERSION_CACHE_KEY, tree["version"], timeout=None)
+    return tree
+
+
+def get_location_tree():
+    """
+    Retrieve the cached location tree snapshot, building it if missing.
+    :return: dict with the snapshot "version", the "graph" (parent id > children ids),
+             the "parents" (location id > parent id) and the "types" (location type > location ids)
+    """
+    tree = cache.get(LOCATION_TREE_CACHE_KEY)
+    if tree is None:
+        tree = cache_location_graph()
+    return tree
+
+
+def get_location_tree_version():
+    """Version of the cached location tree snapshot, without loading the snapshot itself"""
+    version = cache.get(LOCATION_TREE_VERSION_CACHE_KEY)
+    if version is None:
+        version = cache_location_graph()["version"]
+    return version
+
+
+HEALTH_FACILITY_VERSION_CACHE_KEY = "health_facility_version"
+
 
-    cache.set("location_graph", graph, timeout=None)  # Cache indefinitely
-    cache.set("location_types", location_types, timeout=None)
+def get_health_facility_version():
+    """Version of the valid health facilities, changed on every health facility save or delete"""
+    version = cache.get(HEALTH_FACILITY_VERSION_CACHE_KEY)
+    if version is None:
+        version = bump_health_facility_version()
+    return version
+
+
+def bump_health_facility_version():
+    version = uuid.uuid4().hex
+    cache.set(HEALTH_FACILITY_VERSION_CACHE_KEY, version, timeout=None)
+    return version
 
 
 def extend_allowed_locations(location_pks, strict=True, loc_types=None):
@@ -266,10 +581,8 @@ def extend_allowed_locations(location_pks, strict=True, loc_types=None):
         logger.error(
             f"extend_allowed_locations is expecting a list but received {location_pks}"
         )
-    graph = cache.get("location_graph")
-    if not graph:
-        cache_location_graph()
-        graph = cache.get("location_graph")
+    tree = get_location_tree()
+    graph = tree["graph"]
 
     result_pks = set()
     to_visit = set(location_pks)
@@ -294,7 +607,7 @@ def extend_allowed_locations(location_pks, strict=True, loc_types=None):
                     to_visit.add(parent)
         result_pks.update(parents)
     if result_pks and loc_types:
-        location_types = cache.get("location_types")
+        location_types = tree["types"]
         location_types_search = set()
         for t in loc_types:
             if t in location_types:
@@ -310,6 +623,14 @@ def update_location_cache(sender, instance, **kwargs):
     cache_location_graph()
 
 
+def _snapshot(values):
+    # the JSON values (json_ext) can be changed in place, they are copied to still compare with what was loaded
+    return {
+        attname: deepcopy(value) if isinstance(value, (dict, list)) else value
+        for attname, value in values.items()
+    }
+
+
 class Location(core_models.VersionedModel, core_models.ExtendableModel):
     objects = LocationManager()
 
@@ -346,9 +667,94 @@ class Location(core_models.VersionedModel, core_models.ExtendableModel):
     # rowid = models.TextField(db_column='RowId')
     audit_user_id = models.IntegerField(db_column="AuditUserId", blank=True, null=True)
 
+    # changing these fields changes the shape of the location tree
+    TREE_FIELDS = {"parent_id", "type", "validity_to"}
+    # changing these fields only outdates the search indexes, which follow the tree version
+    SEARCH_FIELDS = {"code", "name"}
+
     def __str__(self):
         return self.code + " " + self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # snapshot of the loaded values, to only write (and invalidate on) what changes
+        instance._loaded_values = _snapshot(dict(zip(field_names, values)))
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        # the refreshed values (also the deferred fields, loaded on access) are the new reference
+        loaded_values = getattr(self, "_loaded_values", None)
+        if fields is None:
+            self._loaded_values = _snapshot(self._current_values())
+        elif loaded_values is not None:
+            refreshed = {self._meta.get_field(f).attname for f in fields}
+            loaded_values.update(
+                _snapshot(
+                    {
+                        attname: value
+                        for attname, value in self._current_values().items()
+                        if attname in refreshed
+                    }
+                )
+            )
+
+    def _current_values(self):
+        return {
+            field.attname: getattr(self, field.attname)
+            for field in self._meta.concrete_fields
+            if field.attname in self.__dict__
+        }
+
+    def get_dirty_fields(self):
+        """
+        :return: the attnames of the fields changed since the location was loaded or saved,
+                 None if unknown (location not loaded from the database)
+        """
+        loaded_values = getattr(self, "_loaded_values", None)
+        if loaded_values is None:
+            return None
+        return [
+            attname
+            for attname, value in self._current_values().items()
+            if attname in loaded_values and loaded_values[attname] != value
+        ]
+
+    def _unloaded_fields(self):
+        """:return: the attnames of the fields set without having been loaded (deferred), unknown if changed"""
+        loaded_values = getattr(self, "_loaded_values", None) or {}
+        return [attname for attname in self._current_values() if attname not in loaded_values]
+
+    def save(self, *args, **kwargs):
+        dirty = self.get_dirty_fields()
+        # read by location_changed: None when all the fields may have changed
+        self._changed_fields = None
+        if (
+            dirty is not None
+            and self.pk is not None
+            and not args
+            and not kwargs.get("force_insert")
+            and "update_fields" not in kwargs
+        ):
+            # only write the changed columns (nothing at all, and no signal, if nothing changed)
+            # the fields that were not loaded are written too, but they don't count as changes
+            kwargs["update_fields"] = [
+                f for f in dirty + self._unloaded_fields() if f != self._meta.pk.attname
+            ]
+            self._changed_fields = set(dirty)
+        elif kwargs.get("update_fields") is not None:
+            self._changed_fields = {self._meta.get_field(f).attname for f in kwargs["update_fields"]}
+        loaded_values = getattr(self, "_loaded_values", None)
+        # read by location_changed: the users who saw the location under its previous parent are impacted too
+        self._previous_parent_id = (loaded_values or {}).get("parent_id")
+        self._loaded_values = _snapshot(self._current_values())
+        try:
+            return super().save(*args, **kwargs)
+        except Exception:
+            self._loaded_values = loaded_values
+            raise
+
     @classmethod
     def get_queryset(cls, queryset, user):
         queryset = cls.filter_queryset(queryset)
@@ -366,25 +772,29 @@ class Location(core_models.VersionedModel, core_models.ExtendableModel):
             ) and not user.is_superuser
         ):
             if user.is_officer:
-                from core.models import Officer
-
-                return (
-                    Officer.objects.filter(
-                        code=user.username, has_login=True, validity_to__isnull=True
+                scope = cls.objects.get_officer_scope(user.username, login_only=True)
+                if settings.MSSQL and len(scope) > MAX_QUERY_PARAMS:
+                    return (
+                        core_models.Officer.objects.filter(
+                            code=user.username, has_login=True, validity_to__isnull=True
+                        )
+                        .get()
+                        .officer_allowed_locations
                     )
-                    .get()
-                    .officer_allowed_locations
-                )
+                return Location.objects.filter(id__in=scope)
             elif user.is_claim_admin:
-                from claim.models import ClaimAdmin
-
-                return (
-                    ClaimAdmin.objects.filter(
-                        code=user.username, has_login=True, validity_to__isnull=True
+                scope = cls.objects.get_claim_admin_scope(user.username)
+                if settings.MSSQL and len(scope) > MAX_QUERY_PARAMS:
+                    from claim.models import ClaimAdmin
+
+                    return (
+                        ClaimAdmin.objects.filter(
+                            code=user.username, has_login=True, validity_to__isnull=True
+                        )
+                        .get()
+                        .officer_allowed_locations
                     )
-                    .get()
-                    .officer_allowed_locations
-                )
+                return Location.objects.filter(id__in=scope)
             elif user.is_superuser:
                 return Location.objects
             else:
@@ -521,11 +931,9 @@ class HealthFacility(core_models.VersionedModel, core_models.ExtendableModel):
             queryset = cls.filter_queryset(queryset)
         if settings.ROW_SECURITY and user.is_anonymous:
             return queryset.filter(id=-1)
-        if settings.ROW_SECURITY and not user._u.is_superuser:
-            return LocationManager().build_user_location_filter_query(
-                user._u, queryset=queryset, loc_types=["D"]
-            )
-        return queryset
+        return LocationManager().build_user_location_filter_query(
+            user._u, queryset=queryset, loc_types=["D"]
+        )
 
     class Meta:
         managed = True
@@ -540,6 +948,46 @@ class HealthFacility(core_models.VersionedModel, core_models.ExtendableModel):
     CARE_TYPE_BOTH = "B"
 
 
+@receiver(post_save, sender=HealthFacility)
+@receiver(post_delete, sender=HealthFacility)
+def health_facility_changed(sender, instance, created=False, **kwargs):
+    bump_health_facility_version()
+    if not created:
+        free_cache_for_health_facilities([instance.id])
+
+
+def free_cache_for_health_facilities(health_facility_ids):
+    """
+    Evict the cached locations of the claim administrators of some health facilities,
+    they depend on the location of the health facility.
+    """
+    user_ids = set()
+    codes = []
+    for chunk in chunked(health_facility_ids):
+        user_ids.update(
+            core_models.InteractiveUser.objects.filter(health_facility_id__in=chunk).values_list(
+                "id", flat=True
+            )
+        )
+        if apps.is_installed("claim"):
+            from claim.models import ClaimAdmin
+
+            codes += ClaimAdmin.objects.filter(health_facility_id__in=chunk).values_list(
+                "code", flat=True
+            )
+    cache.delete_many([f"claim_admin_scope_{code}" for code in codes])
+    free_cache_for_login_names(codes)
+    cache.delete_many(
+        [f"{prefix}{user_id}" for user_id in user_ids for prefix in USER_CACHE_PREFIXES]
+    )
+
+
+def claim_admin_changed(sender, instance, **kwargs):
+    """Connected to the ClaimAdmin signals by LocationConfig.ready when the claim module is installed"""
+    cache.delete(f"claim_admin_scope_{instance.code}")
+    free_cache_for_login_names([instance.code])
+
+
 class HealthFacilityCatchment(models.Model):
     id = models.AutoField(db_column="HFCatchmentId", primary_key=True)
     legacy_id = models.IntegerField(db_column="LegacyId", blank=True, null=True)
@@ -562,6 +1010,9 @@ class HealthFacilityCatchment(models.Model):
         db_table = "tblHFCatchment"
 
 
+ALL_DISTRICTS_CACHE_KEY = "all_districts"
+
+
 class UserDistrict(core_models.VersionedModel):
     id = models.AutoField(db_column="UserDistrictID", primary_key=True)
     user = models.ForeignKey(
@@ -574,25 +1025,37 @@ class UserDistrict(core_models.VersionedModel):
         managed = True
         db_table = "tblUsersDistricts"
 
+    # fields of the districts and their regions kept in the user_districts_ cache (what UserDistrictGQLType shows)
+    CACHED_LOCATION_FIELDS = ["id", "uuid", "code", "name", "type", "parent_id"]
+
     @classmethod
     def get_user_districts(cls, user):
         """
-        Retrieve the list of UserDistricts for a user, the locations are prefetched on two levels.
+        Retrieve the list of UserDistricts for a user, with their district and its region already loaded.
+        The districts are cached per user (in one shared entry for the superusers) for the current location
+        tree version (which changes with any location code, name or parent), so that reading them (and their
+        region) doesn't hit the database.
         :param user: InteractiveUser to filter on
-        :return: UserDistrict *objects*
+        :return: UserDistrict *objects*, ordered by region and district code
         """
         if hasattr(user, "_u"):
             user = user._u
-        cachedata = cache.get(f"user_districts_{user.id}")
-        districts = []
-        if cachedata is None:
-            cachedata = []
+        version = get_location_tree_version()
+        # the superusers see all the districts, they share one entry
+        cache_name = ALL_DISTRICTS_CACHE_KEY if user.is_superuser else f"user_districts_{user.id}"
+        cachedata = cache.get(cache_name)
+        if not isinstance(cachedata, dict) or cachedata["version"] != version:
+            lookups = cls.CACHED_LOCATION_FIELDS + [
+                f"parent__{field}" for field in cls.CACHED_LOCATION_FIELDS
+            ]
+            rows = []
             if user.is_superuser:
-                location_ids = Location.objects.filter(
-                    type="D", *filter_validity()
-                ).values_list("id", flat=True)
-                for loc in location_ids:
-                    cachedata.append([0, loc])
+                rows = [
+                    (0, *row)
+                    for row in Location.objects.filter(type="D", *filter_validity())
+                    .order_by("parent__code", "code")
+                    .values_list(*lookups)
+                ]
             elif not isinstance(user, core_models.InteractiveUser):
                 if isinstance(user, core_models.TechnicalUser):
                     logger.warning(
@@ -600,29 +1063,43 @@ class UserDistrict(core_models.VersionedModel):
                         "We'll return an empty list, but it should be handled before reaching here."
                     )
             else:
-                districts = (
+                rows = (
                     UserDistrict.objects.filter(
                         user=user,
                         location__type="D",
                         *filter_validity(),
                         *filter_validity(prefix="location__"),
                     )
-                    .prefetch_related("location")
-                    .prefetch_related("location__parent")
-                    .order_by("location__parent__code")
-                    .order_by("location__code")
+                    .order_by("location__parent__code", "location__code")
+                    .values_list("id", *[f"location__{lookup}" for lookup in lookups])
                 )
-            for d in districts:
-                cachedata.append([d.id, d.location_id])
-
-            cache.set(f"user_districts_{user.id}", cachedata)
-
-        if not districts and cachedata:
-            for d in cachedata:
-                districts.append(UserDistrict(id=d[0], user=user, location_id=d[1]))
+            size = len(cls.CACHED_LOCATION_FIELDS)
+            cachedata = {
+                "version": version,
+                "districts": [
+                    [row[0], row[1:size + 1], row[size + 1:] if row[size + 1] else None]
+                    for row in rows
+                ],
+            }
+            cache.set(cache_name, cachedata, None if user.is_superuser else DEFAULT_TIMEOUT)
 
+        districts = []
+        for district_id, location_values, parent_values in cachedata["districts"]:
+            location = cls._cached_location(location_values)
+            if parent_values:
+                location.parent = cls._cached_location(parent_values)
+            districts.append(UserDistrict(id=district_id, user=user, location=location))
         return districts
 
+    @classmethod
+    def _cached_location(cls, values):
+        # the other fields are deferred, loaded if ever accessed
+        values = dict(zip(cls.CACHED_LOCATION_FIELDS, values))
+        field_names = [
+            field.attname for field in Location._meta.concrete_fields if field.attname in values
+        ]
+        return Location.from_db(None, field_names, [values[name] for name in field_names])
+
     @classmethod
     def get_user_locations(cls, user):
         """
@@ -651,15 +1128,108 @@ class UserDistrict(core_models.VersionedModel):
 
 @receiver(post_save, sender=UserDistrict)
 @receiver(post_delete, sender=UserDistrict)
-def free_cache_post_user_district_save(sender, instance, created, **kwargs):
+def free_cache_post_user_district_save(sender, instance, created=False, **kwargs):
     free_cache_for_user(instance.user_id)
+    if LocationConfig.location_user_scope_table:
+        refresh_user_location_scope(user_ids=[instance.user_id])
+
+
+_invalidation = threading.local()
+
+
+def invalidate_location_caches():
+    # free the user caches first: without Redis, this clears the whole cache, including the tree
+    free_cache_for_user()
+    cache_location_graph()
+
+
+@contextmanager
+def deferred_location_cache_invalidation():
+    """
+    Within this block, the location caches are invalidated once on exit instead of on every location save.
+    Used by the subtree operations, which save a location per node.
+    """
+    if getattr(_invalidation, "deferred", False):
+        yield
+        return
+    _invalidation.deferred = True
+    _invalidation.pending = False
+    _invalidation.scope_roots = set()
+    try:
+        yield
+    finally:
+        _invalidation.deferred = False
+        # expanded once, on the tree as it was before the block
+        scope_locations = (
+            _scope_impacted_locations(_invalidation.scope_roots)
+            if _invalidation.scope_roots and LocationConfig.location_user_scope_table
+            else set()
+        )
+        if _invalidation.pending:
+            invalidate_location_caches()
+        if scope_locations:
+            refresh_user_location_scope(location_ids=scope_locations)
+
+
+def location_scope_impacted(location_ids):
+    """
+    Refresh the scope rows of the users seeing these locations (or their subtrees), after a change the
+    Location receivers don't see (queryset update). Within deferred_location_cache_invalidation, done on exit.
+    """
+    if not LocationConfig.location_user_scope_table:
+        return
+    location_ids = {location_id for location_id in location_ids if location_id}
+    if getattr(_invalidation, "deferred", False):
+        _invalidation.scope_roots |= location_ids
+    elif location_ids:
+        refresh_user_location_scope(location_ids=_scope_impacted_locations(location_ids))
+
+
+def _location_change_impact(instance, signal, created):
+    """:return: "tree" if the tree changed, "search" if only the codes/names changed, None otherwise"""
+    if signal is post_delete:
+        return "tree"
+    if created:
+        # history copies are created outside of the valid tree
+        return "tree" if instance.validity_to is None else None
+    changed = getattr(instance, "_changed_fields", None)
+    if changed is None or changed & Location.TREE_FIELDS:
+        return "tree"
+    if changed & Location.SEARCH_FIELDS:
+        return "search"
+    return None
 
 
 @receiver(post_save, sender=Location)
 @receiver(post_delete, sender=Location)
-def location_changed(sender, instance, **kwargs):
-    update_location_cache(sender, instance, **kwargs)
-    free_cache_for_user()
+def location_changed(sender, instance, signal=None, created=False, **kwargs):
+    impact = _location_change_impact(instance, signal, created)
+    if impact is None:
+        return
+    scope_roots = set()
+    if impact == "tree" and LocationConfig.location_user_scope_table:
+        scope_roots = {
+            location_id
+            for location_id in (
+                instance.id,
+                instance.parent_id,
+                getattr(instance, "_previous_parent_id", None),
+            )
+            if location_id
+        }
+    if getattr(_invalidation, "deferred", False):
+        # only recorded, the tree is read once when the block exits
+        _invalidation.pending = True
+        _invalidation.scope_roots |= scope_roots
+    elif impact == "tree":
+        # computed on the tree before its rebuild, to include what the location leaves
+        scope_locations = _scope_impacted_locations(scope_roots) if scope_roots else set()
+        invalidate_location_caches()
+        if scope_locations:
+            refresh_user_location_scope(location_ids=scope_locations)
+    else:
+        # new tree version, for the search indexes
+        cache_location_graph()
 
 
 class OfficerVillage(core_models.VersionedModel):
@@ -693,7 +1263,170 @@ class OfficerVillage(core_models.VersionedModel):
         return queryset
 
 
-class LocationMutation(core_models.UUIDModel):
+@receiver(post_save, sender=OfficerVillage)
+@receiver(post_delete, sender=OfficerVillage)
+def officer_village_changed(sender, instance, **kwargs):
+    login_names = core_models.Officer.objects.filter(id=instance.officer_id).values("code")
+    cache.delete_many([f"officer_scope_{code}" for code, in login_names.values_list("code")])
+    free_cache_for_login_names(login_names)
+
+
+@receiver(post_save, sender=core_models.Officer)
+@receiver(post_delete, sender=core_models.Officer)
+def officer_changed(sender, instance, created=False, **kwargs):
+    if not created:
+        cache.delete(f"officer_scope_{instance.code}")
+        free_cache_for_login_names([instance.code])
+
+
+class UserLocationScope(models.Model):
+    """
+    Precomputed row security scope of the interactive users: one row per location a user can see, i.e. the
+    valid locations of his UserDistricts, their descendants and their fully covered parents (same rules as
+    LocationManager.allowed). While the location_user_scope_table setting is enabled, it is kept up to date by
+    the UserDistrict and Location receivers; it is (re)built with the rebuild_user_location_scope command.
+    Scope-filtered queries can then join it directly, on any backend.
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(
+        core_models.InteractiveUser,
+        models.DO_NOTHING,
+        db_column="UserID",
+        db_constraint=False,
+        related_name="+",
+    )
+    location = models.ForeignKey(
+        Location,
+        models.DO_NOTHING,
+        db_column="LocationId",
+        db_constraint=False,
+        related_name="+",
+    )
+    type = models.CharField(db_column="LocationType", max_length=1)
+
+    class Meta:
+        managed = True
+        db_table = "user_location_scope"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "location"], name="ux_user_location_scope"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["location", "user"], name="ix_user_location_scope_loc"),
+        ]
+
+
+def _location_types_by_id(tree):
+    return {
+        location_id: location_type
+        for location_type, ids in tree["types"].items()
+        for location_id in ids
+    }
+
+
+def compute_user_location_scope(source_ids, tree=None, location_types=None):
+    """
+    :param source_ids: ids of the UserDistrict locations of a user
+    :param location_types: {location id: type} of the tree, to share it between several users
+    :return: {location id: type} of the locations the user can see
+    """
+    tree = tree or get_location_tree()
+    if location_types is None:
+        location_types = _location_types_by_id(tree)
+    sources = {location_id for location_id in source_ids if location_id in tree["parents"]}
+    scope = extend_allowed_locations(list(sources), True) if sources else set()
+    # a parent whose valid children are all in the sources is covered as well
+    for parent_id in {tree["parents"][location_id] for location_id in sources} - {None}:
+        if tree["graph"].get(parent_id, set()) <= sources:
+            scope.add(parent_id)
+    return {location_id: location_types[location_id] for location_id in scope if location_id in location_types}
+
+
+def _scope_sources(user_ids):
+    """:return: {user id: ids of the locations of his UserDistricts}, the sources of LocationManager.allowed"""
+    sources = {user_id: set() for user_id in user_ids}
+    for chunk in chunked(user_ids):
+        for user_id, location_id in UserDistrict.objects.filter(
+            user_id__in=chunk, *filter_validity()
+        ).values_list("user_id", "location_id"):
+            sources[user_id].add(location_id)
+    return sources
+
+
+def refresh_user_location_scope(user_ids=None, location_ids=None, batch_size=1000):
+    """
+    Bring the scope rows of some users in line with their UserDistricts and the current tree:
+    only the missing rows are inserted and the outdated ones deleted.
+    :param user_ids: the users to refresh
+    :param location_ids: also refresh the users having one of these locations in their scope
+    """
+    user_ids = set(user_ids or [])
+    for chunk in chunked(location_ids or []):
+        user_ids.update(
+            UserLocationScope.objects.filter(location_id__in=chunk)
+            .values_list("user_id", flat=True)
+            .distinct()
+        )
+    if not user_ids:
+        return
+    tree = get_location_tree()
+    location_types = _location_types_by_id(tree)
+    sources = _scope_sources(list(user_ids))
+    for chunk in chunked(user_ids, batch_size):
+        current = {}
+        for row_id, user_id, location_id, location_type in UserLocationScope.objects.filter(
+            user_id__in=chunk
+        ).values_list("id", "user_id", "location_id", "type"):
+            current[(user_id, location_id)] = (row_id, location_type)
+        wanted = {
+            (user_id, location_id): location_type
+            for user_id in chunk
+            for location_id, location_type in compute_user_location_scope(
+                sources[user_id], tree, location_types
+            ).items()
+        }
+        outdated = [
+            row_id
+            for key, (row_id, location_type) in current.items()
+            if wanted.get(key) != location_type
+        ]
+        for outdated_chunk in chunked(outdated):
+            UserLocationScope.objects.filter(id__in=outdated_chunk).delete()
+        UserLocationScope.objects.bulk_create(
+            [
+                UserLocationScope(user_id=user_id, location_id=location_id, type=location_type)
+                for (user_id, location_id), location_type in wanted.items()
+                if current.get((user_id, location_id), (None, None))[1] != location_type
+            ],
+            batch_size=batch_size,
+        )
+
+
+def rebuild_user_location_scope(batch_size=1000):
+    """Refresh the scope of every user with districts or scope rows"""
+    user_ids = set(
+        UserDistrict.objects.filter(*filter_validity()).values_list("user_id", flat=True)
+    )
+    user_ids.update(UserLocationScope.objects.values_list("user_id", flat=True).distinct())
+    refresh_user_location_scope(user_ids=user_ids, batch_size=batch_size)
+    return len(user_ids)
+
+
+def _scope_impacted_locations(root_ids):
+    """
+    Locations whose scope rows may be outdated by a change of the given (changed locations and their
+    current/previous parents): their subtrees and their parents in the cached tree.
+    """
+    tree = get_location_tree()
+    locations = extend_allowed_locations(list(root_ids), True)
+    locations.update(tree["parents"].get(location_id) for location_id in root_ids)
+    locations.discard(None)
+    return locations
+
+
+class LocationMutation(core_models.UUIDModel, core_models.ObjectMutation):
     location = models.ForeignKey(Location, models.DO_NOTHING, related_name="mutations")
     mutation = models.ForeignKey(
         core_models.MutationLog, models.DO_NOTHING, related_name="locations"
@@ -704,7 +1437,7 @@ class LocationMutation(core_models.UUIDModel):
         db_table = "location_LocationMutation"
 
 
-class HealthFacilityMutation(core_models.UUIDModel):
+class HealthFacilityMutation(core_models.UUIDModel, core_models.ObjectMutation):
     health_facility = models.ForeignKey(
         HealthFacility, models.DO_NOTHING, related_name="mutations"
     )
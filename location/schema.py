@@ -1,6 +1,5 @@
 import graphene_django_optimizer as gql_optimizer
 
-from core.models import Officer
 from core.schema import OrderedDjangoFilterConnectionField
 from core.schema import signal_mutation_module_validate
 from django.utils.translation import gettext as _
@@ -13,9 +12,13 @@ from location.gql_mutations import (
     CreateLocationMutation,
     UpdateLocationMutation,
     DeleteLocationMutation,
-    MoveLocationMutation
+    MoveLocationMutation,
+    CreateLocationsMutation,
+    CreateOrUpdateHealthFacilitiesMutation,
 )
 from location.gql_queries import (
+    CodeValidationGQLType,
+    LocationAutocompleteGQLType,
     UserDistrictGQLType,
     LocationGQLType,
     HealthFacilityGQLType,
@@ -25,8 +28,11 @@ from location.models import (
     Location,
     LocationManager,
     UserDistrict,
-    LocationMutation,
-    HealthFacilityMutation,
+)
+from location.search import (
+    autocomplete_locations,
+    search_locations,
+    search_health_facilities,
 )
 from location.services import LocationService, HealthFacilityService
 from location.apps import LocationConfig
@@ -34,7 +40,6 @@ import graphene
 from django.db.models import Q
 from core.utils import filter_validity
 from core import models as core_models
-from django.conf import settings
 
 
 class Query(graphene.ObjectType):
@@ -54,6 +59,15 @@ class Query(graphene.ObjectType):
         LocationGQLType,
         str=graphene.String(),
     )
+    locations_autocomplete = graphene.List(
+        LocationAutocompleteGQLType,
+        str=graphene.String(required=True),
+        type=graphene.String(),
+        parent_uuid=graphene.String(),
+        first=graphene.Int(),
+        description="Prefix search on the code and name of the locations visible by the user, "
+        "served from an in-memory index.",
+    )
     user_districts = graphene.List(UserDistrictGQLType)
     officer_locations = graphene.List(
         LocationGQLType,
@@ -79,6 +93,16 @@ class Query(graphene.ObjectType):
         health_facility_code=graphene.String(required=True),
         description="Checks that the specified health facility code is unique.",
     )
+    validate_location_codes = graphene.List(
+        CodeValidationGQLType,
+        location_codes=graphene.List(graphene.String, required=True),
+        description="Checks, in one query, which of the specified location codes are unique.",
+    )
+    validate_health_facility_codes = graphene.List(
+        CodeValidationGQLType,
+        health_facility_codes=graphene.List(graphene.String, required=True),
+        description="Checks, in one query, which of the specified health facility codes are unique.",
+    )
 
     def resolve_health_facilities(self, info, **kwargs):
         show_history = kwargs.get("showHistory", False) and info.context.user.has_perms(
@@ -92,10 +116,6 @@ class Query(graphene.ObjectType):
         if not show_history:
             query = HealthFacility.filter_queryset(query)
 
-        query = LocationManager().build_user_location_filter_query(
-            info.context.user._u, queryset=query
-        )
-
         return gql_optimizer.query(query.all(), info)
 
     def resolve_validate_location_code(self, info, **kwargs):
@@ -114,6 +134,20 @@ class Query(graphene.ObjectType):
         )
         return False if errors else True
 
+    def resolve_validate_location_codes(self, info, **kwargs):
+        if not info.context.user.has_perms(LocationConfig.gql_query_locations_perms):
+            raise PermissionDenied(_("unauthorized"))
+        codes = kwargs["location_codes"]
+        return _code_validations(codes, LocationService.find_used_codes(codes))
+
+    def resolve_validate_health_facility_codes(self, info, **kwargs):
+        if not info.context.user.has_perms(
+            LocationConfig.gql_query_health_facilities_perms
+        ):
+            raise PermissionDenied(_("unauthorized"))
+        codes = kwargs["health_facility_codes"]
+        return _code_validations(codes, HealthFacilityService.find_used_codes(codes))
+
     def resolve_locations(self, info, **kwargs):
         # OMT-281 allow querying to anyone, with limitations in the get_queryset
         # if not info.context.user.has_perms(LocationConfig.gql_query_locations_perms):
@@ -130,13 +164,26 @@ class Query(graphene.ObjectType):
             raise PermissionDenied(_("unauthorized"))
 
         queryset = Location.get_queryset(None, info.context.user)
-        filters = [*filter_validity(**kwargs)]
+        queryset = queryset.filter(*filter_validity(**kwargs))
 
-        str = kwargs.get("str")
-        if str is not None:
-            filters += [Q(code__icontains=str) | Q(name__icontains=str)]
+        search = kwargs.get("str")
+        if search is not None:
+            queryset = search_locations(queryset, search)
+        return queryset
 
-        return queryset.filter(*filters)
+    def resolve_locations_autocomplete(self, info, **kwargs):
+        if info.context.user.is_anonymous:
+            raise PermissionDenied(_("unauthorized"))
+        return [
+            LocationAutocompleteGQLType(location)
+            for location in autocomplete_locations(
+                info.context.user,
+                kwargs["str"],
+                loc_type=kwargs.get("type"),
+                parent_uuid=kwargs.get("parent_uuid"),
+                limit=kwargs.get("first"),
+            )
+        ]
 
     def resolve_health_facilities_str(self, info, **kwargs):
         if not info.context.user.is_authenticated:
@@ -146,8 +193,6 @@ class Query(graphene.ObjectType):
         district_uuid = kwargs.get("district_uuid")
         district_uuids = kwargs.get("districts_uuids")
         region_uuid = kwargs.get("region_uuid")
-        if search is not None:
-            filters += [Q(code__icontains=search) | Q(name__icontains=search)]
         if district_uuid is not None:
             filters += [Q(location__uuid=district_uuid)]
         if district_uuids is not None:
@@ -157,13 +202,15 @@ class Query(graphene.ObjectType):
             filters += [Q(location__parent__uuid=region_uuid)]
 
         if kwargs.get("ignore_location", False) is False:
-            if settings.ROW_SECURITY and not info.context.user._u.is_superuser:
-                filters += [
-                    LocationManager().build_user_location_filter_query(
-                        info.context.user._u, loc_types=["D"]
-                    )
-                ]
-        return HealthFacility.objects.filter(*filters)
+            filters += [
+                LocationManager().build_user_location_filter_query(
+                    info.context.user._u, loc_types=["D"]
+                )
+            ]
+        queryset = HealthFacility.objects.filter(*filters)
+        if search is not None:
+            queryset = search_health_facilities(queryset, search)
+        return queryset
 
     def resolve_user_districts(self, info, **kwargs):
         if info.context.user.is_anonymous:
@@ -180,14 +227,21 @@ class Query(graphene.ObjectType):
     def resolve_officer_locations(self, info, **kwargs):
         if not info.context.user.has_perms(LocationConfig.gql_query_locations_perms):
             raise PermissionDenied(_("unauthorized"))
-        current_officer = Officer.objects.get(
-            code=kwargs["officer_code"], validity_to__isnull=True
+        locations = Location.objects.filter(
+            id__in=LocationManager().get_officer_scope(kwargs["officer_code"])
         )
         if "location_type" in kwargs:
-            return current_officer.officer_allowed_locations.filter(
-                type=kwargs["location_type"]
-            )
-        return current_officer.officer_allowed_locations
+            return locations.filter(type=kwargs["location_type"])
+        return locations
+
+
+def _code_validations(codes, used_codes):
+    return [
+        CodeValidationGQLType(
+            code=code, available=code not in used_codes, uuid=used_codes.get(code)
+        )
+        for code in codes
+    ]
 
 
 class Mutation(graphene.ObjectType):
@@ -198,23 +252,28 @@ class Mutation(graphene.ObjectType):
     create_health_facility = CreateHealthFacilityMutation.Field()
     update_health_facility = UpdateHealthFacilityMutation.Field()
     delete_health_facility = DeleteHealthFacilityMutation.Field()
+    create_locations = CreateLocationsMutation.Field()
+    create_or_update_health_facilities = CreateOrUpdateHealthFacilitiesMutation.Field()
+
+
+# the location mutations link their record to the mutation log themselves, with the instance they saved
+# (or in bulk for the batches), and report to the mutation log: they only need its id
+MUTATIONS_WITH_LOG_ID = {
+    CreateLocationMutation,
+    UpdateLocationMutation,
+    DeleteLocationMutation,
+    MoveLocationMutation,
+    CreateLocationsMutation,
+    CreateHealthFacilityMutation,
+    UpdateHealthFacilityMutation,
+    DeleteHealthFacilityMutation,
+    CreateOrUpdateHealthFacilitiesMutation,
+}
 
 
 def on_location_mutation(sender, **kwargs):
-    uuid = kwargs["data"].get("uuid", None)
-    if not uuid:
-        return []
-    if "Location" in str(sender._mutation_class):
-        impacted_location = Location.objects.get(uuid=uuid)
-        LocationMutation.objects.create(
-            location=impacted_location, mutation_id=kwargs["mutation_log_id"]
-        )
-    if "HealthFacility" in str(sender._mutation_class):
-        impacted_health_facility = HealthFacility.objects.get(uuid=uuid)
-        HealthFacilityMutation.objects.create(
-            health_facility=impacted_health_facility,
-            mutation_id=kwargs["mutation_log_id"],
-        )
+    if sender in MUTATIONS_WITH_LOG_ID:
+        kwargs["data"]["mutation_log_id"] = kwargs["mutation_log_id"]
     return []
 
 
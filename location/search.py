@@ -0,0 +1,215 @@
+import bisect
+import unicodedata
+
+from core import filter_validity
+from django.db.models import Case, IntegerField, Q, Value, When
+
+from .apps import LocationConfig
+from .models import (
+    HealthFacility,
+    Location,
+    LocationManager,
+    MAX_QUERY_PARAMS,
+    get_health_facility_version,
+    get_location_tree_version,
+)
+
+NGRAM_SIZE = 3
+
+
+def fold(value):
+    """Case and accent folding: "Bégué" > "BEGUE" """
+    decomposed = unicodedata.normalize("NFKD", value or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).upper()
+
+
+class NGramIndex:
+    """
+    In-memory n-gram index over the code and name of a set of records.
+    The candidates of a search are the records sharing all the n-grams of the searched text,
+    they are then checked against the full text to discard false positives.
+    """
+
+    def __init__(self, rows):
+        self.texts = {}
+        self.grams = {}
+        for record_id, code, name in rows:
+            text = f"{fold(code)} {fold(name)}"
+            self.texts[record_id] = text
+            for gram in self._grams(text):
+                self.grams.setdefault(gram, set()).add(record_id)
+
+    @staticmethod
+    def _grams(text):
+        return {text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
+
+    def search(self, text):
+        """
+        :return: the ids of the records whose code or name contains the text,
+                 None if the text is too short to be looked up in the index.
+        """
+        text = fold(text)
+        grams = self._grams(text)
+        if not grams:
+            return None
+        candidates = set.intersection(*(self.grams.get(g, set()) for g in grams))
+        return [c for c in candidates if text in self.texts[c]]
+
+
+class LocationAutocompleteIndex:
+    """
+    In-memory prefix index over the valid locations, for the location pickers.
+    The folded code, full name and name words of each location are kept in a sorted array
+    so that a prefix lookup is a binary search followed by a scan of the matching keys.
+    """
+
+    def __init__(self, rows):
+        self.locations = {}
+        self.ids_by_uuid = {}
+        keys = set()
+        for location_id, location_uuid, code, name, location_type, parent_id in rows:
+            self.locations[location_id] = (location_uuid, code, name, location_type, parent_id)
+            self.ids_by_uuid[str(location_uuid)] = location_id
+            folded_name = fold(name)
+            keys.add((fold(code), location_id))
+            keys.add((folded_name, location_id))
+            keys.update((word, location_id) for word in folded_name.split())
+        self.keys = sorted(keys)
+
+    def _is_under(self, location_id, ancestor_id):
+        parent_id = self.locations[location_id][4]
+        while parent_id is not None and parent_id in self.locations:
+            if parent_id == ancestor_id:
+                return True
+            parent_id = self.locations[parent_id][4]
+        return False
+
+    def search(self, text, loc_type=None, parent_uuid=None, allowed=None, limit=None):
+        """
+        :param text: prefix of the code, the name or a word of the name
+        :param loc_type: only return locations of this type
+        :param parent_uuid: only return locations below this location (at any level)
+        :param allowed: ids of the locations the user can see, None for all
+        :param limit: maximum number of results
+        :return: list of (id, uuid, code, name, type, parent_id) tuples, ordered by matched key
+        """
+        prefix = fold(text)
+        parent_id = self.ids_by_uuid.get(parent_uuid) if parent_uuid else None
+        if parent_uuid and parent_id is None:
+            return []
+        result = []
+        seen = set()
+        for key, location_id in self.keys[bisect.bisect_left(self.keys, (prefix,)):]:
+            if not key.startswith(prefix):
+                break
+            if location_id in seen:
+                continue
+            seen.add(location_id)
+            location = self.locations[location_id]
+            if loc_type and location[3] != loc_type:
+                continue
+            if allowed is not None and location_id not in allowed:
+                continue
+            if parent_id is not None and not self._is_under(location_id, parent_id):
+                continue
+            result.append((location_id, *location))
+            if limit and len(result) >= limit:
+                break
+        return result
+
+
+_in_memory_indexes = {}
+
+
+def _get_in_memory_index(name, version, index_class, rows_function):
+    """Retrieve the in-process index for the given version, rebuilding it if outdated."""
+    current = _in_memory_indexes.get(name)
+    if current is None or current[0] != version:
+        current = (version, index_class(rows_function()))
+        _in_memory_indexes[name] = current
+    return current[1]
+
+
+def _location_index():
+    return _get_in_memory_index(
+        "locations",
+        get_location_tree_version(),
+        NGramIndex,
+        lambda: Location.objects.filter(*filter_validity()).values_list(
+            "id", "code", "name"
+        ),
+    )
+
+
+def _health_facility_index():
+    return _get_in_memory_index(
+        "health_facilities",
+        get_health_facility_version(),
+        NGramIndex,
+        lambda: HealthFacility.objects.filter(*filter_validity()).values_list(
+            "id", "code", "name"
+        ),
+    )
+
+
+def _search(queryset, text, index_function):
+    if LocationConfig.location_search_backend == "ngram":
+        candidates = index_function().search(text)
+        if candidates is not None and len(candidates) > MAX_QUERY_PARAMS:
+            candidates = None
+    else:
+        candidates = None
+
+    if candidates is not None:
+        queryset = queryset.filter(id__in=candidates)
+    else:
+        queryset = queryset.filter(Q(code__icontains=text) | Q(name__icontains=text))
+
+    # no limit here: the connection fields still have to filter the result, the pagination bounds it
+    return queryset.annotate(
+        search_rank=Case(
+            When(code__iexact=text, then=Value(0)),
+            When(code__istartswith=text, then=Value(1)),
+            When(name__istartswith=text, then=Value(2)),
+            default=Value(3),
+            output_field=IntegerField(),
+        )
+    ).order_by("search_rank", "code")
+
+
+def search_locations(queryset, text):
+    """
+    Filter the locations whose code or name contains the text, the best matches first.
+    :param queryset: Location queryset, already limited to what the user can see
+    """
+    return _search(queryset, text, _location_index)
+
+
+def search_health_facilities(queryset, text):
+    """
+    Filter the health facilities whose code or name contains the text, the best matches first.
+    :param queryset: HealthFacility queryset, already limited to what the user can see
+    """
+    return _search(queryset, text, _health_facility_index)
+
+
+def autocomplete_locations(user, text, loc_type=None, parent_uuid=None, limit=None):
+    """
+    Prefix search of the valid locations visible by the user, served from memory.
+    The index is rebuilt when the location tree version changes.
+    """
+    index = _get_in_memory_index(
+        "locations_autocomplete",
+        get_location_tree_version(),
+        LocationAutocompleteIndex,
+        lambda: Location.objects.filter(*filter_validity()).values_list(
+            "id", "uuid", "code", "name", "type", "parent_id"
+        ),
+    )
+    return index.search(
+        text,
+        loc_type=loc_type,
+        parent_uuid=parent_uuid,
+        allowed=LocationManager().get_user_scope(user),
+        limit=limit if limit is not None else LocationConfig.location_search_limit,
+    )
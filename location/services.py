@@ -1,3 +1,4 @@
+import copy
 import json
 from typing import Union
 from uuid import UUID
@@ -5,9 +6,12 @@ from uuid import UUID
 from django.contrib.auth.models import AnonymousUser
 from django.core.exceptions import PermissionDenied, ValidationError
 from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
 from django.db.models import Q
 from django.utils.translation import gettext as _
 
+from core import filter_validity
+from core.models import MutationLog
 from core.signals import register_service_signal
 from location.apps import LocationConfig
 from location.models import (
@@ -15,9 +19,37 @@ from location.models import (
     HealthFacility,
     HealthFacilityCatchment,
     UserDistrict,
+    chunked,
+    location_scope_impacted,
 )
 
 
+# unique indexes on the live codes, see migration 0021
+LOCATION_CODE_UNIQUE_INDEX = "ux_tblLocations_code_live"
+HEALTH_FACILITY_CODE_UNIQUE_INDEX = "ux_tblHF_code_live"
+
+
+def is_unique_index_violation(exc: IntegrityError, index_name):
+    return index_name in str(exc)
+
+
+def update_mutation_log_ext(mutation_log_id, key, **values):
+    """
+    Merge values in the json_ext[key] of a mutation log.
+    Like MutationLog.mark_as_*, only the json_ext is updated so that the status set by another process is kept.
+    The row is locked between the read and the write so that concurrent updates don't overwrite each other.
+    """
+    with transaction.atomic():
+        json_ext = (
+            MutationLog.objects.select_for_update()
+            .filter(id=mutation_log_id)
+            .values_list("json_ext", flat=True)
+            .first()
+        ) or {}
+        json_ext.setdefault(key, {}).update(values)
+        MutationLog.objects.filter(id=mutation_log_id).update(json_ext=json_ext)
+
+
 def check_authentication(function):
     def wrapper(self, *args, **kwargs):
         if type(self.user) is AnonymousUser or not self.user.id:
@@ -70,6 +102,17 @@ class HealthFacilityLevel:
         return _output_result_success(LocationConfig.health_facility_level)
 
 
+def _find_used_codes(model, codes):
+    used = {}
+    for chunk in chunked(set(codes)):
+        used.update(
+            model.objects.filter(code__in=chunk, validity_to__isnull=True).values_list(
+                "code", "uuid"
+            )
+        )
+    return used
+
+
 def _output_result_success(dict_representation):
     return {
         "success": True,
@@ -85,44 +128,58 @@ class LocationService:
 
     @staticmethod
     def check_unique_code(code):
-        if Location.objects.filter(code=code, validity_to__isnull=True).exists():
+        if LocationService.find_used_codes([code]):
             return [{"message": "Location code %s already exists" % code}]
         return []
 
-    def validate_data(self, **data):
-        error = None
-        error = self.check_unique_code(data["code"])
-
-        return error
+    @staticmethod
+    def find_used_codes(codes):
+        """
+        :param codes: location codes to check
+        :return: dict of the uuid of the valid location using the code, for the codes already in use
+        """
+        return _find_used_codes(Location, codes)
 
     @register_service_signal("location_service.update_or_create")
     def update_or_create(self, data):
         location_uuid = data.pop("uuid") if "uuid" in data else None
         parent_uuid = data.pop("parent_uuid") if "parent_uuid" in data else None
-        incoming_code = data.get("code")
-        current_location = Location.objects.filter(uuid=location_uuid).first()
-        current_code = current_location.code if current_location else None
-        if current_code != incoming_code:
-            if self.check_unique_code(incoming_code):
-                raise ValidationError(_("mutation.location_code_duplicated"))
         # update_or_create(uuid=location_uuid, ...)
         # doesn't work because of explicit attempt to set null to uuid!
         self._check_users_locations_rights(data["type"])
-        if location_uuid:
-            location = Location.objects.get(uuid=location_uuid)
-            self._reset_location_before_update(location)
-            [setattr(location, key, data[key]) for key in data]
-        else:
-            error = self.validate_data(**data)
-            if error:
-                raise ValueError(error)
-            else:
-                location = Location.objects.create(**data)
-
-        if parent_uuid:
-            location.parent = Location.objects.get(uuid=parent_uuid)
-        location.save()
+        # the uniqueness of the live codes is enforced by the database
+        try:
+            with transaction.atomic():
+                # the location and its parent are loaded with one query
+                uuids = [u for u in (location_uuid, parent_uuid) if u]
+                loaded = (
+                    {str(loc.uuid).lower(): loc for loc in Location.objects.filter(uuid__in=uuids)}
+                    if uuids
+                    else {}
+                )
+                if location_uuid:
+                    location = self._loaded(loaded, location_uuid)
+                    self._reset_location_before_update(location)
+                    [setattr(location, key, data[key]) for key in data]
+                else:
+                    location = Location(**data)
+
+                if parent_uuid:
+                    location.parent = self._loaded(loaded, parent_uuid)
+                location.save()
+        except IntegrityError as exc:
+            if is_unique_index_violation(exc, LOCATION_CODE_UNIQUE_INDEX):
+                raise ValidationError(_("mutation.location_code_duplicated"))
+            raise
         self._ensure_user_belongs_to_district(location)
+        return location
+
+    @staticmethod
+    def _loaded(loaded, location_uuid):
+        # MSSQL returns the uniqueidentifiers in upper case
+        if str(location_uuid).lower() not in loaded:
+            raise Location.DoesNotExist(f"Location {location_uuid} does not exist")
+        return loaded[str(location_uuid).lower()]
 
     def _check_users_locations_rights(self, loc_type):
         if self.user.is_superuser or self.user.has_perms(
@@ -160,12 +217,20 @@ class HealthFacilityService:
 
     @staticmethod
     def check_unique_code(code):
-        if HealthFacility.objects.filter(code=code, validity_to__isnull=True).exists():
+        if HealthFacilityService.find_used_codes([code]):
             return [{"message": "Health facility code %s already exists" % code}]
         return []
 
-    @register_service_signal("health_facility_service.update_or_create")
-    def update_or_create(self, data):
+    @staticmethod
+    def find_used_codes(codes):
+        """
+        :param codes: health facility codes to check
+        :return: dict of the uuid of the valid health facility using the code, for the codes already in use
+        """
+        return _find_used_codes(HealthFacility, codes)
+
+    @staticmethod
+    def validate_contract_and_status(data):
         contract_start_date = data.get("contract_start_date", None)
         contract_end_date = data.get("contract_end_date", None)
         if LocationConfig.health_facility_contract_dates_mandatory:
@@ -181,55 +246,74 @@ class HealthFacilityService:
             "status" in data and data["status"] not in HealthFacility.HealthFacilityStatus
         ):
             raise ValidationError(_("mutation.incorrect_hf_status"))
+
+    @register_service_signal("health_facility_service.update_or_create")
+    def update_or_create(self, data):
+        self.validate_contract_and_status(data)
         hf_uuid = data.pop("uuid") if "uuid" in data else None
         catchments = data.pop("catchments") if "catchments" in data else []
         # address may be multiline > sent as JSON
         # update_or_create(uuid=location_uuid, ...)
         # doesn't work because of explicit attempt to set null to uuid!
-        prev_hf_id = None
-        if hf_uuid:
-            hf = HealthFacility.objects.get(uuid=hf_uuid)
-            if hf.validity_to:
-                raise ValidationError(_("cannot_update_historical_hf"))
-            prev_hf_id = hf.save_history()
-            # reset the non required fields
-            # (each update is 'complete', necessary to be able to set 'null')
-            self._reset_health_facility_before_update(hf)
-            [setattr(hf, key, data[key]) for key in data]
-        else:
-            hf = HealthFacility.objects.create(**data)
-        self._process_catchments(catchments, prev_hf_id, hf.id, hf.catchments)
-        hf.save()
+        # the uniqueness of the live codes is enforced by the database
+        try:
+            with transaction.atomic():
+                prev_hf_id = None
+                if hf_uuid:
+                    hf = HealthFacility.objects.get(uuid=hf_uuid)
+                    if hf.validity_to:
+                        raise ValidationError(_("cannot_update_historical_hf"))
+                    prev_hf_id = hf.save_history()
+                    # reset the non required fields
+                    # (each update is 'complete', necessary to be able to set 'null')
+                    self._reset_health_facility_before_update(hf)
+                    [setattr(hf, key, data[key]) for key in data]
+                else:
+                    hf = HealthFacility.objects.create(**data)
+                self._process_catchments(catchments, prev_hf_id, hf.id, hf.catchments)
+                hf.save()
+        except IntegrityError as exc:
+            if is_unique_index_violation(exc, HEALTH_FACILITY_CODE_UNIQUE_INDEX):
+                raise ValidationError(_("mutation.hf_code_duplicated"))
+            raise
         return hf
 
     def _process_catchments(self, data_catchments, prev_hf_id, hf_id, catchments):
-        prev_catchments = [c.id for c in catchments.all()]
+        """
+        Diff the submitted catchments against the current ones, loaded once:
+        unchanged ones are kept, changed ones are moved to the history (prev_hf) and recreated,
+        new ones are created and the ones no longer submitted are closed on the history.
+        """
         from core.utils import TimeUtils
 
+        now = TimeUtils.now()
+        prev_catchments = {c.id: c for c in catchments.all()}
+        moved = []
+        created = []
         for catchment in data_catchments:
             catchment_id = catchment.pop("id") if "id" in catchment else None
-            if catchment_id:
-                prev_catchments.remove(catchment_id)
-                prev_catchment = catchments.filter(id=catchment_id, **catchment).first()
-                if not prev_catchment:
-                    # catchment has been updated, let's bind the old value to prev_hf
-                    prev_catchment = catchments.get(id=catchment_id)
-                    prev_catchment.health_facility_id = prev_hf_id
-                    prev_catchment.save()
-                    # ... and create a new one with the new values
-                    catchment["validity_from"] = TimeUtils.now()
-                    catchment["audit_user_id"] = self.user.id_for_audit
-                    catchment["health_facility_id"] = hf_id
-                    HealthFacilityCatchment.objects.create(**catchment)
-            else:
-                catchment["validity_from"] = TimeUtils.now()
-                catchment["audit_user_id"] = self.user.id_for_audit
-                catchment["health_facility_id"] = hf_id
-                HealthFacilityCatchment.objects.create(**catchment)
+            prev_catchment = prev_catchments.pop(catchment_id, None) if catchment_id else None
+            if prev_catchment is not None:
+                if all(getattr(prev_catchment, key) == value for key, value in catchment.items()):
+                    continue
+                # catchment has been updated, let's bind the old value to prev_hf
+                prev_catchment.health_facility_id = prev_hf_id
+                moved.append(prev_catchment)
+            # ... and create a new one with the new values
+            created.append(
+                HealthFacilityCatchment(
+                    **catchment,
+                    validity_from=now,
+                    audit_user_id=self.user.id_for_audit,
+                    health_facility_id=hf_id,
+                )
+            )
 
+        HealthFacilityCatchment.objects.bulk_update(moved, ["health_facility"])
+        HealthFacilityCatchment.objects.bulk_create(created)
         if prev_catchments:
-            catchments.filter(id__in=prev_catchments).update(
-                health_facility_id=prev_hf_id, validity_to=TimeUtils.now()
+            HealthFacilityCatchment.objects.filter(id__in=list(prev_catchments)).update(
+                health_facility_id=prev_hf_id, validity_to=now
             )
 
     @staticmethod
@@ -248,3 +332,84 @@ class HealthFacilityService:
         hf.care_type = None
         hf.services_pricelist = None
         hf.items_pricelist = None
+
+
+def tree_delete(parents, now):
+    """Close the validity of all the descendants of the parents, level by level
+    :return: the number of closed locations"""
+    if parents:
+        children = Location.objects.filter(
+            parent__in=parents
+        )  # .filter(*filter_validity())
+        org_children = copy.copy(children)
+        count = children.update(validity_to=now)
+        return count + tree_delete(org_children, now)
+    return 0
+
+
+def tree_reset_types(parent, location, new_level):
+    """Re-type the moved location and its descendants after a move to another level
+    :return: the number of re-typed descendants"""
+    if new_level >= len(LocationConfig.location_types):
+        location.parent = parent.parent
+        location.type = LocationConfig.location_types[-1]
+        return 0
+    location.type = LocationConfig.location_types[new_level]
+    count = 0
+    for child in location.children.filter(*filter_validity()).all():
+        child.save_history()
+        count += 1 + tree_reset_types(location, child, new_level + 1)
+        child.save()
+    return count
+
+
+def delete_location(location_id, new_parent_id=None):
+    """
+    Close the validity of a location and of its subtree,
+    or move its children to new_parent_id if provided.
+    :return: dict with the number of impacted "locations"
+    """
+    from core import datetime
+
+    now = datetime.datetime.now()
+    location = Location.objects.get(id=location_id)
+    if new_parent_id:
+        count = (
+            Location.objects.filter(parent=location)
+            .filter(*filter_validity())
+            .update(parent_id=new_parent_id)
+        )
+    else:
+        count = tree_delete((location,), now)
+
+    location.validity_to = now
+    location.save()
+    if new_parent_id:
+        # the children moved by the update now show up in the scope of the users of the new parent
+        location_scope_impacted([new_parent_id])
+    if location.type == "D":
+        UserDistrict.objects.filter(location=location, validity_to__isnull=True).update(
+            validity_to=now
+        )
+    return {"locations": count + 1}
+
+
+def move_location(location_id, new_parent_id=None):
+    """
+    Move a location (and its subtree) under new_parent_id,
+    re-typing the subtree when it lands on another level.
+    :return: dict with the number of impacted "locations"
+    """
+    location = Location.objects.get(id=location_id)
+    location.save_history()
+    level = LocationConfig.location_types.index(location.type)
+    new_parent = Location.objects.get(id=new_parent_id) if new_parent_id else None
+    np_level = (
+        LocationConfig.location_types.index(new_parent.type) if new_parent else -1
+    )
+    location.parent = new_parent
+    count = 0
+    if np_level < level - 1 or np_level >= level:
+        count = tree_reset_types(new_parent, location, np_level + 1)
+    location.save()
+    return {"locations": count + 1}
@@ -0,0 +1,108 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from celery import shared_task
+from core.models import MutationLog
+from django.db import connection, transaction
+from django.utils.translation import gettext as _
+
+from .apps import LocationConfig
+from .models import deferred_location_cache_invalidation
+from .services import delete_location, move_location, update_mutation_log_ext
+
+logger = logging.getLogger(__name__)
+
+LOCATION_OPERATIONS = {
+    "delete": delete_location,
+    "move": move_location,
+}
+# key of the progress of the background operation in the json_ext of the mutation log
+PROGRESS_KEY = "location_operation"
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="location")
+    return _executor
+
+
+def run_location_operation(operation, **kwargs):
+    """
+    Run a subtree operation in one transaction, invalidating the location caches once at the end.
+    :return: the counters returned by the operation
+    """
+    with deferred_location_cache_invalidation():
+        with transaction.atomic():
+            return LOCATION_OPERATIONS[operation](**kwargs)
+
+
+def run_tracked_location_operation(mutation_log_id, operation, **kwargs):
+    """
+    Run a subtree operation outside of the request, tracking it on the mutation log.
+    The mutation itself is marked as successful by core once the operation is queued: the state of the
+    operation is in json_ext[PROGRESS_KEY] ("queued", "running", then "done" or "failed") and a failed
+    operation turns the mutation log to ERROR.
+    """
+    update_mutation_log_ext(mutation_log_id, PROGRESS_KEY, state="running")
+    try:
+        result = run_location_operation(operation, **kwargs)
+    except Exception as exc:
+        logger.warning(
+            f"Location {operation} of mutation {mutation_log_id} failed", exc_info=True
+        )
+        update_mutation_log_ext(mutation_log_id, PROGRESS_KEY, state="failed")
+        mutation_log = MutationLog.objects.filter(id=mutation_log_id).first()
+        if mutation_log:
+            mutation_log.mark_as_failed(
+                json.dumps(
+                    [
+                        {
+                            "message": _("location.mutation.background_operation_failed"),
+                            "detail": str(exc),
+                        }
+                    ]
+                )
+            )
+        return
+    update_mutation_log_ext(mutation_log_id, PROGRESS_KEY, state="done", **result)
+
+
+@shared_task
+def location_operation_async(mutation_log_id, operation, **kwargs):
+    run_tracked_location_operation(mutation_log_id, operation, **kwargs)
+    return "OK"
+
+
+def _run_in_thread(mutation_log_id, operation, kwargs):
+    try:
+        run_tracked_location_operation(mutation_log_id, operation, **kwargs)
+    finally:
+        connection.close()
+
+
+def submit_location_operation(mutation_log_id, operation, **kwargs):
+    """
+    Run a subtree operation according to the location_background_mutations configuration:
+    "sync" runs it right away (errors are raised to the mutation), "thread" hands it over to an
+    in-process executor and "celery" to the workers. The background modes need the mutation log
+    to report on and start once the current transaction is committed.
+    """
+    mode = LocationConfig.location_background_mutations
+    if mode == "sync" or not mutation_log_id:
+        run_location_operation(operation, **kwargs)
+        return
+    update_mutation_log_ext(mutation_log_id, PROGRESS_KEY, state="queued", operation=operation)
+    if mode == "celery":
+        transaction.on_commit(
+            lambda: location_operation_async.delay(mutation_log_id, operation, **kwargs)
+        )
+    else:
+        transaction.on_commit(
+            lambda: _get_executor().submit(
+                _run_in_thread, mutation_log_id, operation, kwargs
+            )
+        )
@@ -1,21 +1,49 @@
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import QuerySet
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from location.test_helpers import (
     create_test_village,
     create_test_health_facility,
     create_test_location,
     assign_user_districts,
 )
+from location.apps import LocationConfig
+from location.exporters import csv_lines, export_locations, location_export_fields
+from location.importers import HealthFacilityImportService, LocationImportService
+from location.services import HealthFacilityService, LocationService
+from location.tasks import PROGRESS_KEY, run_location_operation, run_tracked_location_operation
+from location.search import LocationAutocompleteIndex, NGramIndex, search_locations
 from core.test_helpers import create_test_officer, create_test_interactive_user
 from claim.test_helpers import create_test_claim_admin
 from django.core.cache import caches
 
-from location.models import LocationManager
+from location.models import (
+    ALL_DISTRICTS_CACHE_KEY,
+    HealthFacility,
+    Location,
+    LocationManager,
+    LOCATION_TREE_CACHE_KEY,
+    OfficerVillage,
+    extend_allowed_locations,
+    get_location_tree,
+    get_location_tree_version,
+    rebuild_user_location_scope,
+    UserDistrict,
+    UserLocationScope,
+)
 from core.services import (
     create_or_update_interactive_user,
     create_or_update_core_user,
     create_or_update_user_districts,
 )
 from core.utils import filter_validity
+from core.models import MutationLog
 from core.models.user import Role
 
 _TEST_USER_NAME = "test_batch_run"
@@ -31,6 +59,65 @@ _TEST_DATA_USER = {
 }
 
 
+# Reference implementation of the strict scope, with correlated COUNT subqueries per candidate parent
+_CORRELATED_ALLOWED_SQL = f"""
+    WITH {"" if settings.MSSQL else "RECURSIVE"} USER_LOC AS
+        (SELECT l."LocationId", l."ParentLocationId" FROM "tblUsersDistricts" ud
+        JOIN "tblLocations" l ON ud."LocationId" = l."LocationId"
+        WHERE ud."ValidityTo"  is Null AND "UserID" = %s ),
+     CTE_PARENTS AS (
+    SELECT parent."LocationId", parent."LocationType", parent."ParentLocationId"
+    FROM "tblLocations" parent
+    WHERE "LocationId" in (SELECT "LocationId" FROM USER_LOC)
+    OR (  parent."LocationId" in  (SELECT "ParentLocationId" FROM USER_LOC)
+        AND (
+            SELECT COUNT(*) FROM USER_LOC  ul
+            WHERE ul."ParentLocationId" = parent."LocationId" ) =  (
+                SELECT COUNT(*) FROM "tblLocations" l
+                WHERE l."ParentLocationId" = parent."LocationId" AND l."ValidityTo" is Null
+            ))
+    UNION ALL
+    SELECT child."LocationId", child."LocationType", child."ParentLocationId"
+    FROM "tblLocations"  child
+        INNER JOIN CTE_PARENTS leaf ON child."ParentLocationId" = leaf."LocationId"
+    )
+    SELECT DISTINCT "LocationId" FROM CTE_PARENTS
+"""
+
+
+def _create_synthetic_tree(prefix, regions=2, districts=5, wards=8, villages=8):
+    """Bulk create a 4-level tree, returns the created districts per region"""
+    common = {"validity_from": "2019-06-01", "audit_user_id": -1}
+
+    def create_level(loc_type, parents, count):
+        children = [
+            Location(
+                code=f"{prefix}{loc_type}{parent_index}-{i}"[:8],
+                name=f"{prefix} {loc_type} {parent_index}-{i}",
+                type=loc_type,
+                parent=parent,
+                **common,
+            )
+            for parent_index, parent in enumerate(parents)
+            for i in range(count)
+        ]
+        Location.objects.bulk_create(children)
+        return list(
+            Location.objects.filter(
+                code__in=[c.code for c in children], validity_to__isnull=True
+            ).order_by("id")
+        )
+
+    region_list = create_level("R", [None], regions)
+    district_list = create_level("D", region_list, districts)
+    ward_list = create_level("W", district_list, wards)
+    create_level("V", ward_list, villages)
+    return {
+        region.id: [d for d in district_list if d.parent_id == region.id]
+        for region in region_list
+    }
+
+
 # Create your tests here.
 class LocationTest(TestCase):
     test_village = None
@@ -87,18 +174,198 @@ class LocationTest(TestCase):
 
     def test_parents(self):
         hierachy = LocationManager().parents(self.test_village.id)
+        self.assertIsInstance(hierachy, QuerySet)
         self.assertEqual(len(hierachy), 4)
         district = LocationManager().parents(self.test_village.id, loc_type="D")
         self.assertEqual(len(district), 1)
+        self.assertEqual(
+            LocationManager().parents(self.test_village.id, loc_type="D", values_only=True),
+            [self.test_village.parent.parent_id],
+        )
 
     def test_children(self):
         hierachy = LocationManager().children(self.test_village.parent.parent.parent.id)
+        self.assertIsInstance(hierachy, QuerySet)
         self.assertEqual(len(hierachy), 5)
         district = LocationManager().children(
             self.test_village.parent.parent.parent.id, loc_type="D"
         )
         self.assertEqual(len(district), 2)
 
+    def test_parents_multiple_ids(self):
+        ids = [self.test_village.id, self.other_loc.id]
+        hierarchy = LocationManager().parents(ids)
+        # the region is shared by both locations
+        self.assertEqual(len(hierarchy), 5)
+        districts = LocationManager().parents(ids, loc_type="D")
+        self.assertEqual(
+            {d.id for d in districts},
+            {self.other_loc.id, self.test_village.parent.parent_id},
+        )
+        cached = LocationManager().parents(ids, loc_type="D", from_cache=True)
+        self.assertEqual({d.id for d in cached}, {d.id for d in districts})
+
+    def test_children_from_cache(self):
+        region_id = self.test_village.parent.parent.parent_id
+        self.assertEqual(
+            {x.id for x in LocationManager().children(region_id, from_cache=True)},
+            {x.id for x in LocationManager().children(region_id)},
+        )
+        # more descendants than MSSQL can bind: not served from the cache
+        descendants = LocationManager().children(region_id, values_only=True)
+        with self.settings(MSSQL=True), patch("location.models.MAX_QUERY_PARAMS", 2):
+            self.assertIsNone(LocationManager()._from_ids(descendants))
+
+    def test_children_depth_and_values(self):
+        region_id = self.test_village.parent.parent.parent_id
+        districts = {self.other_loc.id, self.test_village.parent.parent_id}
+        for from_cache in (False, True):
+            self.assertEqual(
+                set(
+                    LocationManager().children(
+                        region_id, loc_type="D", values_only=True, from_cache=from_cache
+                    )
+                ),
+                districts,
+            )
+            self.assertEqual(
+                len(
+                    LocationManager().children(
+                        region_id, max_depth=1, from_cache=from_cache
+                    )
+                ),
+                3,
+            )
+
+    def test_ngram_index(self):
+        index = NGramIndex([(1, "KGL01", "Kigali"), (2, "GSB01", "Gasabo"), (3, "X", None)])
+        self.assertEqual(index.search("igal"), [1])
+        self.assertEqual(sorted(index.search("B01")), [2])
+        self.assertEqual(index.search("zzz"), [])
+        self.assertIsNone(index.search("ki"))
+
+    def test_autocomplete_index(self):
+        index = LocationAutocompleteIndex(
+            [
+                (1, "u1", "R1", "Région Sud", "R", None),
+                (2, "u2", "R1D1", "Bégué", "D", 1),
+                (3, "u3", "R1D1W1", "Sud Bégué", "W", 2),
+                (4, "u4", "R2", "Nord", "R", None),
+            ]
+        )
+        self.assertEqual([x[0] for x in index.search("begu")], [2, 3])
+        self.assertEqual([x[0] for x in index.search("sud")], [1, 3])
+        self.assertEqual([x[0] for x in index.search("r1", loc_type="D")], [2])
+        self.assertEqual([x[0] for x in index.search("r", parent_uuid="u1")], [2, 3])
+        self.assertEqual([x[0] for x in index.search("r", allowed={4})], [4])
+        self.assertEqual(len(index.search("r", limit=2)), 2)
+
+    def test_search_locations_ranking(self):
+        result = list(
+            search_locations(Location.objects.filter(validity_to__isnull=True), "NOTALLO")
+        )
+        self.assertEqual(result[0].id, self.other_loc.id)
+
+    def test_search_locations_filtered_after_search(self):
+        for i in range(3):
+            create_test_location("W", custom_props={"code": f"SRCHW{i}", "parent": self.other_loc})
+        village = create_test_location("V", custom_props={"code": "XSRCHV", "parent": self.test_village.parent})
+        result = search_locations(Location.objects.filter(validity_to__isnull=True), "SRCH")
+        # the connection filters apply to the whole result, matches on any part of the code are kept
+        self.assertEqual([loc.id for loc in result.filter(type="V")], [village.id])
+        self.assertEqual(result.count(), 4)
+
+    def test_update_or_create_returns_location(self):
+        admin = create_test_interactive_user(username="locupsadmin")
+        region = create_test_location("R", custom_props={"code": "UPSR1"})
+        data = {"code": "UPSD1", "name": "District", "type": "D", "audit_user_id": -1}
+        district = LocationService(admin).update_or_create({**data, "parent_uuid": region.uuid})
+        self.assertEqual(district.parent_id, region.id)
+        with CaptureQueriesContext(connection) as queries:
+            updated = LocationService(admin).update_or_create(
+                {**data, "name": "Renamed", "uuid": district.uuid, "parent_uuid": region.uuid}
+            )
+        self.assertEqual((updated.id, updated.name), (district.id, "Renamed"))
+        # the location and its parent are loaded together
+        lookups = [q for q in queries if '"LocationUUID"' in q["sql"] and q["sql"].startswith("SELECT")]
+        self.assertEqual(len(lookups), 1)
+        # the uuids are matched whatever their case (MSSQL returns them in upper case)
+        self.assertEqual(
+            LocationService._loaded({str(district.uuid).lower(): district}, str(district.uuid).upper()),
+            district,
+        )
+
+    def test_save_only_writes_changed_fields(self):
+        location = Location.objects.get(id=self.test_village.id)
+        location.male_population = 42
+        tree = get_location_tree()
+        with CaptureQueriesContext(connection) as queries:
+            location.save()
+        updates = [q["sql"] for q in queries if q["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        self.assertIn("MalePopulation", updates[0])
+        self.assertNotIn("LocationName", updates[0])
+        # a population change has no impact on the tree
+        self.assertEqual(get_location_tree()["version"], tree["version"])
+
+        with CaptureQueriesContext(connection) as queries:
+            location.save()
+        self.assertFalse([q for q in queries if q["sql"].startswith("UPDATE")])
+
+        location.parent = self.test_village.parent.parent
+        location.save()
+        self.assertNotEqual(get_location_tree()["version"], tree["version"])
+
+    def test_save_after_refresh_from_db(self):
+        location = Location.objects.get(id=self.test_village.id)
+        location.male_population = 5
+        location.save()
+        Location.objects.filter(id=location.id).update(male_population=7)
+        location.refresh_from_db()
+        # back to the value saved before the refresh: still a change
+        location.male_population = 5
+        location.save()
+        self.assertEqual(Location.objects.get(id=location.id).male_population, 5)
+
+    def test_save_with_deferred_fields(self):
+        tree = get_location_tree()
+        location = Location.objects.defer("parent", "type").get(id=self.test_village.id)
+        # loaded on access: not a change
+        self.assertEqual(location.parent_id, self.test_village.parent_id)
+        location.female_population = 4
+        location.save()
+        self.assertEqual(get_location_tree()["version"], tree["version"])
+        # set without being loaded: written, without invalidating the tree
+        location.type = "V"
+        location.male_population = 3
+        location.save()
+        self.assertEqual(Location.objects.get(id=location.id).male_population, 3)
+        self.assertEqual(get_location_tree()["version"], tree["version"])
+
+    def test_save_writes_json_ext_changed_in_place(self):
+        location = Location.objects.get(id=self.test_village.id)
+        if location.json_ext is None:
+            location.json_ext = {}
+            location.save()
+        location.json_ext["source"] = "import"
+        location.save()
+        self.assertEqual(
+            Location.objects.get(id=self.test_village.id).json_ext.get("source"), "import"
+        )
+
+    def test_duplicate_code_rejected_by_unique_index(self):
+        admin = create_test_interactive_user(username="locdupadmin")
+        with self.assertRaises(ValidationError):
+            LocationService(admin).update_or_create(
+                {
+                    "code": self.other_loc.code,
+                    "name": "Duplicate",
+                    "type": "V",
+                    "parent_uuid": self.test_village.parent.uuid,
+                    "audit_user_id": -1,
+                }
+            )
+
     def test_allowed_location(self):
         allowed = LocationManager().allowed(
             self.test_user._u.id, loc_types=["V", "D", "W"]
@@ -124,6 +391,86 @@ class LocationTest(TestCase):
         cached = caches["location"].get(f"user_locations_{self.test_user._u.id}")
         self.assertIsNotNone(cached)
 
+    def test_user_location_scope(self):
+        user_id = self.test_user._u.id
+
+        def scope():
+            return set(
+                UserLocationScope.objects.filter(user_id=user_id).values_list("location_id", flat=True)
+            )
+
+        # only maintained once enabled
+        create_test_location("V", custom_props={"code": "SCPV0", "parent": self.test_village.parent})
+        self.assertFalse(scope())
+
+        allowed = LocationManager().allowed(user_id, qs=True)
+        with patch.object(LocationConfig, "location_user_scope_table", True):
+            rebuild_user_location_scope()
+            self.assertEqual(scope(), set(allowed.values_list("id", flat=True)))
+
+            # maintained incrementally when the tree changes
+            village = create_test_location(
+                "V", custom_props={"code": "SCPV1", "parent": self.test_village.parent}
+            )
+            self.assertIn(village.id, scope())
+            village.validity_to = "2020-01-01"
+            village.save()
+            self.assertNotIn(village.id, scope())
+
+            UserLocationScope.objects.filter(user_id=user_id).delete()
+            rebuild_user_location_scope()
+            self.assertEqual(scope(), set(allowed.values_list("id", flat=True)))
+
+    def test_user_location_scope_delete_with_new_parent(self):
+        user_id = self.test_user._u.id
+        district = self.test_village.parent.parent
+        with patch.object(LocationConfig, "location_user_scope_table", True):
+            rebuild_user_location_scope()
+            ward = create_test_location("W", custom_props={"code": "SCPW1", "parent": self.other_loc})
+            village = create_test_location("V", custom_props={"code": "SCPV2", "parent": ward})
+            new_ward = create_test_location("W", custom_props={"code": "SCPW2", "parent": district})
+            run_location_operation("delete", location_id=ward.id, new_parent_id=new_ward.id)
+        self.assertIn(
+            village.id,
+            UserLocationScope.objects.filter(user_id=user_id).values_list("location_id", flat=True),
+        )
+
+    def test_user_scope_matches_get_queryset(self):
+        # a user whose districts cover all the districts of a region sees the region too
+        region = create_test_location("R", custom_props={"code": "SCPR1"})
+        create_test_location("D", custom_props={"code": "SCPD1", "parent": region})
+        covering_user = create_test_interactive_user(username="tst_scope_cover", roles=[1])
+        assign_user_districts(covering_user, ["SCPD1"])
+        with self.settings(ROW_SECURITY=True):
+            for user in (self.test_user, self.test_user_eo, self.test_user_ca, covering_user):
+                expected = set(
+                    Location.get_queryset(None, user)
+                    .filter(validity_to__isnull=True)
+                    .values_list("id", flat=True)
+                )
+                self.assertEqual(LocationManager().get_user_scope(user), expected, user.username)
+            self.assertIn(region.id, LocationManager().get_user_scope(covering_user))
+
+    def test_allowed_mssql_uses_scope_table(self):
+        # the same fixture through the PostgreSQL CTE and through the MSSQL scope table
+        ward = create_test_location("W", custom_props={"code": "SCPW3", "parent": self.test_village.parent.parent})
+        closed = create_test_location("V", custom_props={"code": "SCPV3", "parent": ward})
+        closed.validity_to = "2020-01-01"
+        closed.save()
+        # the officer villages are not a source of allowed (officers are scoped by get_officer_scope)
+        OfficerVillage.objects.create(officer=self.test_eo, location=self.other_loc, audit_user_id=-1)
+        rebuild_user_location_scope()
+        for user in (self.test_user, self.test_user_eo):
+            user_id = user._u.id
+            expected = set(LocationManager().allowed(user_id, qs=True).values_list("id", flat=True))
+            self.assertNotIn(closed.id, expected)
+            self.assertNotIn(self.other_loc.id, expected)
+            with self.settings(MSSQL=True), patch.object(LocationConfig, "location_user_scope_table", True):
+                allowed = LocationManager().allowed(user_id, qs=True)
+                self.assertIn("user_location_scope", str(allowed.query))
+                self.assertEqual(set(allowed.values_list("id", flat=True)), expected, user.username)
+        self.assertIn(ward.id, LocationManager().allowed(self.test_user._u.id, qs=True).values_list("id", flat=True))
+
     def test_cache_invalidation(self):
         LocationManager().is_allowed(self.test_user, [])
         cached = caches["location"].get(f"user_locations_{self.test_user._u.id}")
@@ -138,6 +485,95 @@ class LocationTest(TestCase):
         cached = caches["location"].get(f"user_locations_{self.test_user._u.id}")
         self.assertIsNone(cached, "cache not cleared")
 
+    def test_cache_invalidation_officer_and_claim_admin(self):
+        eo_cache = f"user_locations_{self.test_user_eo._u.id}"
+        ca_cache = f"user_locations_{self.test_user_ca._u.id}"
+        LocationManager().get_allowed_ids(self.test_user_eo)
+        LocationManager().get_allowed_ids(self.test_user_ca)
+        self.assertIsNotNone(caches["location"].get(eo_cache))
+        self.assertIsNotNone(caches["location"].get(ca_cache))
+
+        village = create_test_location(
+            "V", custom_props={"code": "EOVIL3", "parent": self.test_village.parent}
+        )
+        OfficerVillage.objects.create(officer=self.test_eo, location=village, audit_user_id=-1)
+        self.assertIsNone(caches["location"].get(eo_cache), "officer cache not cleared")
+        self.assertIn(village.id, LocationManager().get_allowed_ids(self.test_user_eo))
+
+        self.test_hf.location = self.other_loc
+        self.test_hf.save()
+        self.assertIsNone(caches["location"].get(ca_cache), "claim admin cache not cleared")
+        self.assertEqual(
+            LocationManager().get_allowed_ids(self.test_user_ca), [self.other_loc.id]
+        )
+
+    def test_import_moving_health_facility_evicts_claim_admin_cache(self):
+        ca_cache = f"user_locations_{self.test_user_ca._u.id}"
+        LocationManager().get_allowed_ids(self.test_user_ca)
+        admin = create_test_interactive_user(username="tst_hf_import_admin")
+        result = HealthFacilityImportService(admin).import_health_facilities(
+            [
+                {
+                    "code": self.test_hf.code,
+                    "name": self.test_hf.name,
+                    "legal_form": self.test_hf.legal_form_id,
+                    "level": self.test_hf.level,
+                    "care_type": self.test_hf.care_type,
+                    "location_code": self.other_loc.code,
+                }
+            ]
+        )
+        self.assertEqual(result["updated"], 1)
+        self.assertIsNone(caches["location"].get(ca_cache), "claim admin cache not cleared")
+        self.assertEqual(LocationManager().get_allowed_ids(self.test_user_ca), [self.other_loc.id])
+
+    def test_import_refreshes_updated_health_facility_cache(self):
+        # fill the object cache with the current version
+        HealthFacility.objects.get(id=self.test_hf.id)
+        admin = create_test_interactive_user(username="tst_hf_import_cache")
+        result = HealthFacilityImportService(admin).import_health_facilities(
+            [
+                {
+                    "code": self.test_hf.code,
+                    "name": "Renamed by import",
+                    "legal_form": self.test_hf.legal_form_id,
+                    "level": self.test_hf.level,
+                    "care_type": self.test_hf.care_type,
+                    "location_code": self.test_hf.location.code,
+                }
+            ]
+        )
+        self.assertEqual(result["updated"], 1)
+        self.assertEqual(HealthFacility.objects.get(id=self.test_hf.id).name, "Renamed by import")
+        self.assertEqual(HealthFacility.objects.get(uuid=self.test_hf.uuid).name, "Renamed by import")
+
+    def test_user_districts_from_cache(self):
+        district = self.test_village.parent.parent
+        UserDistrict.get_user_districts(self.test_user)
+        with self.assertNumQueries(0):
+            districts = UserDistrict.get_user_districts(self.test_user)
+            self.assertEqual([d.location_id for d in districts], [district.id])
+            self.assertEqual(districts[0].location.code, district.code)
+            self.assertEqual(districts[0].location.parent.uuid, district.parent.uuid)
+        # renaming the district changes the tree version
+        district.name = "Renamed district"
+        district.save()
+        districts = UserDistrict.get_user_districts(self.test_user)
+        self.assertEqual(districts[0].location.name, "Renamed district")
+
+    def test_superuser_districts_shared(self):
+        # without roles, the test users are IMIS administrators
+        admin = create_test_interactive_user(username="tst_adm_dist")
+        other_admin = create_test_interactive_user(username="tst_adm_dist2")
+        districts = UserDistrict.get_user_districts(admin)
+        self.assertIn(self.test_village.parent.parent_id, [d.location_id for d in districts])
+        self.assertIsNotNone(caches["location"].get(ALL_DISTRICTS_CACHE_KEY))
+        self.assertIsNone(caches["location"].get(f"user_districts_{admin._u.id}"))
+        other_districts = UserDistrict.get_user_districts(other_admin)
+        self.assertEqual(
+            [d.location_id for d in other_districts], [d.location_id for d in districts]
+        )
+
     def test_allowed_location_eo(self):
         self.assertFalse(
             LocationManager().is_allowed(
@@ -175,6 +611,46 @@ class LocationTest(TestCase):
             "is_allowed function is not working as supposed",
         )
 
+    def test_officer_and_claim_admin_scopes(self):
+        village = self.test_village
+        self.assertEqual(
+            LocationManager().get_officer_scope(self.test_eo.code),
+            set(self.test_eo.officer_allowed_locations.values_list("id", flat=True)),
+        )
+        self.assertEqual(
+            set(Location.get_queryset(None, self.test_user_eo).values_list("id", flat=True)),
+            {village.id, village.parent_id, village.parent.parent_id, village.parent.parent.parent_id},
+        )
+        self.assertEqual(
+            LocationManager().get_claim_admin_scope(self.test_ca.code),
+            set(self.test_ca.officer_allowed_locations.values_list("id", flat=True)),
+        )
+        # served from the cache
+        with self.assertNumQueries(0):
+            LocationManager().get_officer_scope(self.test_eo.code)
+        # invalidated when the villages of the officer change
+        other_village = create_test_location(
+            "V", custom_props={"code": "EOVIL2", "parent": self.other_loc}
+        )
+        OfficerVillage.objects.create(officer=self.test_eo, location=other_village, audit_user_id=-1)
+        self.assertIn(other_village.id, LocationManager().get_officer_scope(self.test_eo.code))
+        # more locations than MSSQL can bind
+        with self.settings(MSSQL=True, ROW_SECURITY=True), patch("location.models.MAX_QUERY_PARAMS", 1):
+            self.assertEqual(
+                set(Location.get_queryset(None, self.test_user_eo).values_list("id", flat=True)),
+                set(self.test_eo.officer_allowed_locations.values_list("id", flat=True)),
+            )
+        # the user of an officer without login sees nothing
+        self.test_eo.has_login = False
+        self.test_eo.save()
+        try:
+            with self.settings(ROW_SECURITY=True):
+                self.assertFalse(Location.get_queryset(None, self.test_user_eo).exists())
+            self.assertIn(other_village.id, LocationManager().get_officer_scope(self.test_eo.code))
+        finally:
+            self.test_eo.has_login = True
+            self.test_eo.save()
+
     def test_allowed_location_ca(self):
         self.assertFalse(
             LocationManager().is_allowed(
@@ -215,3 +691,228 @@ class LocationTest(TestCase):
             ),
             "is_allowed function is not working as supposed",
         )
+
+    def test_location_tree_snapshot(self):
+        caches["location"].delete(LOCATION_TREE_CACHE_KEY)
+        district_id = self.test_village.parent.parent_id
+        allowed = extend_allowed_locations([district_id], True, ["V"])
+        self.assertEqual(list(allowed), [self.test_village.id])
+        tree = get_location_tree()
+        self.assertIn(self.test_village.id, tree["types"]["V"])
+        self.assertIn(self.test_village.id, tree["graph"][self.test_village.parent_id])
+        self.assertEqual(
+            caches["location"].get(LOCATION_TREE_CACHE_KEY)["version"], tree["version"]
+        )
+        # the version is readable on its own
+        self.assertEqual(get_location_tree_version(), tree["version"])
+        create_test_location("V", custom_props={"code": "TREEV1", "parent": self.test_village.parent})
+        self.assertNotEqual(get_location_tree_version(), tree["version"])
+        self.assertEqual(get_location_tree_version(), get_location_tree()["version"])
+
+
+class LocationAllowedSyntheticTreeTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        districts_by_region = list(_create_synthetic_tree("B").values())
+        cls.test_user = create_test_interactive_user(username="locbench")
+        # the first region is fully covered, the second one only partially
+        assign_user_districts(
+            cls.test_user,
+            [d.code for d in districts_by_region[0]] + [districts_by_region[1][0].code],
+        )
+
+    def test_allowed_matches_correlated_scope(self):
+        user_id = self.test_user._u.id
+        with connection.cursor() as cursor:
+            cursor.execute(_CORRELATED_ALLOWED_SQL, (user_id,))
+            expected = {x for x, in cursor.fetchall()}
+        # the whole scope in one query, whatever the number of districts
+        with self.assertNumQueries(1):
+            allowed = set(LocationManager().allowed(user_id).values_list("id", flat=True))
+        self.assertEqual(allowed, expected)
+        self.assertEqual(
+            Location.objects.filter(id__in=allowed, type="R").count(), 1
+        )
+
+    def test_allowed_ids_cached(self):
+        LocationManager().get_allowed_ids(self.test_user)
+        # served from the cache, without any query
+        with self.assertNumQueries(0):
+            LocationManager().get_allowed_ids(self.test_user)
+
+
+@skipUnless(connection.vendor == "postgresql", "query plans are only checked on PostgreSQL")
+class LocationIndexesTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.test_village = create_test_village()
+
+    def _last_query_plan(self, function):
+        with CaptureQueriesContext(connection) as context:
+            function()
+        with connection.cursor() as cursor:
+            # make the planner pick an index whenever one is usable, even on a tiny table
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute("EXPLAIN " + context.captured_queries[-1]["sql"])
+            return "\n".join(row[0] for row in cursor.fetchall())
+
+    def test_children_cte_uses_parent_index(self):
+        region_id = self.test_village.parent.parent.parent_id
+        plan = self._last_query_plan(
+            lambda: LocationManager().children(region_id, values_only=True)
+        )
+        self.assertIn("ix_tblLocations_parent_validity", plan)
+        self.assertNotIn('Seq Scan on "tblLocations"', plan)
+
+    def test_check_unique_code_uses_code_index(self):
+        plan = self._last_query_plan(lambda: LocationService.check_unique_code("NOPE"))
+        # the live codes only: the partial unique index is the smallest one covering the query
+        self.assertIn("ux_tblLocations_code_live", plan)
+        self.assertNotIn('Seq Scan on "tblLocations"', plan)
+
+
+class LocationImportTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = create_test_interactive_user(username="locimportadmin")
+
+    def test_import_locations(self):
+        rows = [
+            {"code": "IMPW1", "name": "Ward 1", "type": "W", "parent_code": "IMPD1"},
+            {"code": "IMPR1", "name": "Region 1", "type": "R"},
+            {"code": "IMPD1", "name": "District 1", "type": "D", "parent_code": "IMPR1"},
+            {"code": "IMPV1", "name": "Village 1", "type": "V", "parent_code": "IMPW1",
+             "male_population": "10"},
+            {"code": "IMPD1", "name": "Duplicate", "type": "D", "parent_code": "IMPR1"},
+            {"code": "IMPV2", "name": "Orphan", "type": "V", "parent_code": "NOPE"},
+        ]
+        result = LocationImportService(self.admin, chunk_size=2).import_locations(rows)
+        self.assertEqual(result["created"], 4)
+        self.assertEqual(sorted(line for line, _ in result["errors"]), [5, 6])
+        village = Location.objects.get(code="IMPV1", validity_to__isnull=True)
+        self.assertEqual(village.male_population, 10)
+        self.assertEqual(village.parent.parent.parent.code, "IMPR1")
+        self.assertIn(village.id, get_location_tree()["types"]["V"])
+
+    def test_import_locations_dry_run(self):
+        result = LocationImportService(self.admin).import_locations(
+            [{"code": "IMPR2", "name": "Region 2", "type": "R"}], dry_run=True
+        )
+        self.assertEqual(result["created"], 1)
+        self.assertFalse(Location.objects.filter(code="IMPR2").exists())
+
+    def test_import_health_facilities(self):
+        village = create_test_village({"code": "IMPHV"})
+        other_village = create_test_village({"code": "IMPHV2"})
+        district = village.parent.parent
+        hf = create_test_health_facility("IMPHF1", district.id, valid=True)
+        row = {
+            "code": "IMPHF1",
+            "name": "Renamed",
+            "legal_form": "C",
+            "level": "H",
+            "care_type": "B",
+            "location_code": district.code,
+            "catchments": [{"location_code": "IMPHV", "catchment": 100}],
+        }
+        rows = [
+            row,
+            {**row, "code": "IMPHF2", "catchments": [{"location_code": "IMPHV2", "catchment": 50}]},
+            {**row, "code": "IMPHF3", "location_code": "NOPE"},
+            {**row, "code": "IMPHF4", "legal_form": None},
+        ]
+        service = HealthFacilityImportService(self.admin, chunk_size=2)
+        result = service.import_health_facilities(rows)
+        self.assertEqual((result["created"], result["updated"]), (1, 1))
+        self.assertEqual([line for line, _ in result["errors"]], [3, 4])
+
+        current = HealthFacility.objects.get(code="IMPHF1", validity_to__isnull=True)
+        self.assertEqual((current.id, current.name), (hf.id, "Renamed"))
+        self.assertTrue(HealthFacility.objects.filter(legacy_id=hf.id, name=hf.name).exists())
+        self.assertEqual(
+            list(current.catchments.filter(validity_to__isnull=True).values_list("location_id", "catchment")),
+            [(village.id, 100)],
+        )
+
+        # changing a catchment keeps the previous value on the history
+        row["catchments"] = [{"location_code": "IMPHV2", "catchment": 10}]
+        service.import_health_facilities([row])
+        live = current.catchments.filter(validity_to__isnull=True)
+        self.assertEqual(list(live.values_list("location_id", "catchment")), [(other_village.id, 10)])
+        self.assertEqual(HealthFacility.objects.filter(legacy_id=hf.id).count(), 2)
+
+
+class LocationExportTest(TestCase):
+    def test_export_locations(self):
+        village = create_test_village({"code": "EXPV1"})
+        rows = {row["code"]: row for row in export_locations() if row["type"] in ("W", "V")}
+        row = rows["EXPV1"]
+        ward = village.parent
+        self.assertEqual(row["parent_code"], ward.code)
+        self.assertEqual(row["W_code"], ward.code)
+        self.assertEqual(row["D_code"], ward.parent.code)
+        self.assertEqual(row["R_code"], ward.parent.parent.code)
+        self.assertEqual(rows[ward.code]["D_code"], ward.parent.code)
+
+        lines = list(csv_lines(location_export_fields(), [row]))
+        self.assertTrue(lines[0].startswith("uuid,code,name,type,parent_code,R_code,D_code,W_code"))
+        self.assertIn(f"EXPV1,Test Village,V,{ward.code}", lines[1])
+
+
+class HealthFacilityServiceTest(TestCase):
+    def test_process_catchments(self):
+        admin = create_test_interactive_user(username="hfcatchmentadmin")
+        villages = [create_test_village({"code": f"CATV{i}"}) for i in range(3)]
+        hf = create_test_health_facility("CATHF", villages[0].parent.parent.id, valid=True)
+        history = create_test_health_facility("CATHFH", villages[0].parent.parent.id, valid=False)
+        kept, changed, removed = [
+            hf.catchments.create(
+                location=village, catchment=10, validity_from="2019-01-01", audit_user_id=-1
+            )
+            for village in villages
+        ]
+        service = HealthFacilityService(admin)
+        with CaptureQueriesContext(connection) as queries:
+            service._process_catchments(
+                [
+                    {"id": kept.id, "location_id": villages[0].id, "catchment": 10},
+                    {"id": changed.id, "location_id": villages[1].id, "catchment": 20},
+                    {"location_id": villages[2].id, "catchment": 30},
+                ],
+                history.id,
+                hf.id,
+                hf.catchments,
+            )
+        # select, bulk update, bulk insert, closing update
+        self.assertLessEqual(len(queries), 4)
+        live = hf.catchments.filter(validity_to__isnull=True)
+        self.assertEqual(
+            sorted(live.values_list("location_id", "catchment")),
+            sorted([(villages[0].id, 10), (villages[1].id, 20), (villages[2].id, 30)]),
+        )
+        self.assertIn(kept.id, live.values_list("id", flat=True))
+        changed.refresh_from_db()
+        removed.refresh_from_db()
+        self.assertEqual(changed.health_facility_id, history.id)
+        self.assertEqual((removed.health_facility_id, removed.catchment), (history.id, 10))
+        self.assertIsNotNone(removed.validity_to)
+
+
+class LocationBackgroundOperationTest(TestCase):
+    def test_tracked_delete(self):
+        village = create_test_village({"code": "BGV1"})
+        ward = village.parent
+        mutation_log = MutationLog.objects.create(json_content="{}")
+        run_tracked_location_operation(mutation_log.id, "delete", location_id=ward.id)
+        mutation_log.refresh_from_db()
+        self.assertEqual(mutation_log.json_ext[PROGRESS_KEY], {"state": "done", "locations": 2})
+        self.assertFalse(Location.objects.filter(id__in=[ward.id, village.id], validity_to__isnull=True).exists())
+        self.assertNotIn(village.id, get_location_tree()["parents"])
+
+    def test_tracked_failure(self):
+        # core marks the mutation as successful once the operation is queued
+        mutation_log = MutationLog.objects.create(json_content="{}", status=MutationLog.SUCCESS)
+        run_tracked_location_operation(mutation_log.id, "move", location_id=-1)
+        mutation_log.refresh_from_db()
+        self.assertEqual(mutation_log.json_ext[PROGRESS_KEY]["state"], "failed")
+        self.assertEqual(mutation_log.status, MutationLog.ERROR)
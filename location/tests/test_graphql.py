@@ -3,12 +3,15 @@ import json
 from dataclasses import dataclass
 import uuid
 
-from core.models import User
+from core.models import MutationLog, User
 from core.test_helpers import create_test_interactive_user
 from django.conf import settings
 from django.core import exceptions
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from graphene_django.utils.testing import GraphQLTestCase
 from graphql_jwt.shortcuts import get_token
+from location.gql_mutations import CreateLocationMutation, UpdateLocationMutation
 from location.models import Location, HealthFacility, HealthFacilityLegalForm
 from location.test_helpers import (
     create_test_health_facility,
@@ -229,6 +232,27 @@ class LocationGQLTestCase(GraphQLTestCase):
         self.assertIsNotNone(content["data"]["locations"]["edges"][0]["node"]["id"])
         self.assertIsNotNone(content["data"]["locations"]["edges"][0]["node"]["name"])
 
+    def test_validate_location_codes(self):
+        response = self.query(
+            """
+            query {
+                validateLocationCodes(locationCodes: ["%s", "NEWCODE1"]) {
+                    code available uuid
+                }
+            }
+            """
+            % self.test_region.code,
+            headers={"HTTP_AUTHORIZATION": f"Bearer {self.admin_token}"},
+        )
+        self.assertResponseNoErrors(response)
+        content = json.loads(response.content)
+        used, free = content["data"]["validateLocationCodes"]
+        self.assertEqual(used["code"], self.test_region.code)
+        self.assertFalse(used["available"])
+        self.assertEqual(used["uuid"], str(self.test_region.uuid))
+        self.assertTrue(free["available"])
+        self.assertIsNone(free["uuid"])
+
     def test_mutation_create_location(self):
         response = self.query(
             """
@@ -268,11 +292,177 @@ class LocationGQLTestCase(GraphQLTestCase):
         self.assertEqual(db_location.female_population, 2)
         self.assertEqual(db_location.families, 3)
         self.assertEqual(db_location.other_population, 4)
+        # the created location is linked to its mutation
+        self.assertTrue(
+            db_location.mutations.filter(mutation__client_mutation_id="tstlocgql1").exists()
+        )
 
         retrieved_item = self._getLocationFromAPI(code="tstrgx")
         self.assertIsNotNone(retrieved_item)
         self.assertEqual(retrieved_item["name"], db_location.name)
 
+    def test_mutation_without_mutation_log_id(self):
+        # as run by the asynchronous mutation runner, which rebuilds the data from the mutation log
+        mutation_log = MutationLog.objects.create(
+            json_content="{}", client_mutation_id="tstlocasync1", user=self.admin_user
+        )
+        errors = CreateLocationMutation.async_mutate(
+            self.admin_user,
+            client_mutation_id="tstlocasync1",
+            code="tstrga",
+            name="Test Region Async",
+            type="R",
+        )
+        self.assertIsNone(errors)
+        db_location = Location.objects.get(code="tstrga", validity_to__isnull=True)
+        self.assertTrue(db_location.mutations.filter(mutation=mutation_log).exists())
+
+    def test_mutation_update_location_linked(self):
+        location = create_test_location(
+            "V", custom_props={"code": "tstupd1", "parent_id": self.test_ward.id}
+        )
+        mutation_log = MutationLog.objects.create(json_content="{}", user=self.admin_user)
+        errors = UpdateLocationMutation.async_mutate(
+            self.admin_user,
+            mutation_log_id=mutation_log.id,
+            uuid=str(location.uuid),
+            code="tstupd1",
+            name="Updated",
+            type="V",
+        )
+        self.assertIsNone(errors)
+        self.assertTrue(location.mutations.filter(mutation=mutation_log).exists())
+
+        # a failed update is linked too
+        failed_log = MutationLog.objects.create(json_content="{}", user=self.admin_user)
+        errors = UpdateLocationMutation.async_mutate(
+            self.admin_user,
+            mutation_log_id=failed_log.id,
+            uuid=str(location.uuid),
+            code=self.test_village.code,
+            name="Duplicate code",
+            type="V",
+        )
+        self.assertTrue(errors)
+        self.assertTrue(location.mutations.filter(mutation=failed_log).exists())
+
+    def test_mutation_create_locations(self):
+        response = self.query(
+            """
+            mutation {
+              createLocations(input: {
+                clientMutationId: "tstlocbatch1",
+                locations: [
+                  {code: "tstbd1", name: "Batch District", type: "D", parentCode: "tstbr1"},
+                  {code: "tstbr1", name: "Batch Region", type: "R"},
+                ]
+              }) {
+                internalId
+                clientMutationId
+              }
+            }
+            """,
+            headers={"HTTP_AUTHORIZATION": f"Bearer {self.admin_token}"},
+        )
+        self.assertResponseNoErrors(response)
+
+        district = Location.objects.get(code="tstbd1", validity_to__isnull=True)
+        self.assertEqual(district.parent.code, "tstbr1")
+        mutation_log = MutationLog.objects.get(client_mutation_id="tstlocbatch1")
+        self.assertEqual(mutation_log.status, MutationLog.SUCCESS)
+        self.assertEqual(
+            [r["code"] for r in mutation_log.json_ext["location_batch"]["results"]],
+            ["tstbd1", "tstbr1"],
+        )
+        self.assertTrue(district.mutations.filter(mutation=mutation_log).exists())
+
+    def test_mutation_create_locations_all_or_nothing(self):
+        self.query(
+            """
+            mutation {
+              createLocations(input: {
+                clientMutationId: "tstlocbatch2",
+                locations: [
+                  {code: "tstbr2", name: "Batch Region 2", type: "R"},
+                  {code: "tstbd2", name: "Orphan District", type: "D", parentCode: "nope"},
+                ]
+              }) {
+                internalId
+              }
+            }
+            """,
+            headers={"HTTP_AUTHORIZATION": f"Bearer {self.admin_token}"},
+        )
+        mutation_log = MutationLog.objects.get(client_mutation_id="tstlocbatch2")
+        self.assertEqual(mutation_log.status, MutationLog.ERROR)
+        self.assertEqual(len(json.loads(mutation_log.error)), 1)
+        self.assertFalse(Location.objects.filter(code="tstbr2").exists())
+
+    def test_mutation_create_locations_with_updates(self):
+        ward = create_test_location(
+            "W", custom_props={"code": "tstbw3", "name": "Batch Ward", "parent_id": self.test_district.id}
+        )
+        response = self.query(
+            """
+            mutation {
+              createLocations(input: {
+                clientMutationId: "tstlocbatch3",
+                locations: [
+                  {code: "tstbv3", name: "Batch Village", type: "V", parentUuid: "%s"},
+                  {uuid: "%s", code: "tstbw3", name: "Renamed Ward", type: "W", parentUuid: "%s"},
+                ]
+              }) {
+                internalId
+              }
+            }
+            """
+            % (ward.uuid, ward.uuid, self.test_district.uuid),
+            headers={"HTTP_AUTHORIZATION": f"Bearer {self.admin_token}"},
+        )
+        self.assertResponseNoErrors(response)
+        mutation_log = MutationLog.objects.get(client_mutation_id="tstlocbatch3")
+        self.assertEqual(mutation_log.status, MutationLog.SUCCESS)
+        self.assertEqual(
+            Location.objects.get(uuid=ward.uuid, validity_to__isnull=True).name, "Renamed Ward"
+        )
+        village = Location.objects.get(code="tstbv3", validity_to__isnull=True)
+        self.assertEqual(
+            mutation_log.json_ext["location_batch"]["results"],
+            [{"code": "tstbv3", "uuid": str(village.uuid)}, {"code": "tstbw3", "uuid": str(ward.uuid)}],
+        )
+        self.assertEqual(
+            set(mutation_log.locations.values_list("location_id", flat=True)), {village.id, ward.id}
+        )
+
+    def test_mutation_create_locations_rejected_update(self):
+        ward = create_test_location(
+            "W", custom_props={"code": "tstbw4", "name": "Batch Ward", "parent_id": self.test_district.id}
+        )
+        self.query(
+            """
+            mutation {
+              createLocations(input: {
+                clientMutationId: "tstlocbatch4",
+                locations: [
+                  {code: "tstbv4", name: "Batch Village", type: "V", parentUuid: "%s"},
+                  {uuid: "%s", code: "%s", name: "Duplicate code", type: "W", parentUuid: "%s"},
+                ]
+              }) {
+                internalId
+              }
+            }
+            """
+            % (ward.uuid, ward.uuid, self.test_ward.code, self.test_district.uuid),
+            headers={"HTTP_AUTHORIZATION": f"Bearer {self.admin_token}"},
+        )
+        mutation_log = MutationLog.objects.get(client_mutation_id="tstlocbatch4")
+        self.assertEqual(mutation_log.status, MutationLog.ERROR)
+        # one error for the rejected item, the created one is rolled back too
+        self.assertEqual(len(json.loads(mutation_log.error)), 1)
+        self.assertFalse(Location.objects.filter(code="tstbv4").exists())
+        self.assertEqual(Location.objects.get(uuid=ward.uuid, validity_to__isnull=True).name, "Batch Ward")
+        self.assertNotIn("location_batch", mutation_log.json_ext or {})
+
     def test_mutation_delete_location(self):
         response = self.query(
             """
@@ -534,6 +724,70 @@ class HealthFacilityGQLTestCase(GraphQLTestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def _create_or_update_health_facilities(self, client_mutation_id, items):
+        return self.query(
+            """
+            mutation {
+              createOrUpdateHealthFacilities(input: {
+                clientMutationId: "%s",
+                healthFacilities: [%s]
+              }) {
+                internalId
+              }
+            }
+            """
+            % (
+                client_mutation_id,
+                ", ".join(
+                    '{code: "%s", name: "%s", legalForm: "C", level: "H", careType: "B", locationCode: "%s"}'
+                    % item
+                    for item in items
+                ),
+            ),
+            headers={"HTTP_AUTHORIZATION": f"Bearer {self.admin_token}"},
+        )
+
+    def test_mutation_create_or_update_health_facilities(self):
+        response = self._create_or_update_health_facilities(
+            "tsthfbatch1",
+            [
+                ("tsthfb1", "Batch HF", self.test_district.code),
+                (self.test_hf.code, "Renamed HF", self.test_district.code),
+            ],
+        )
+        self.assertResponseNoErrors(response)
+        mutation_log = MutationLog.objects.get(client_mutation_id="tsthfbatch1")
+        self.assertEqual(mutation_log.status, MutationLog.SUCCESS)
+        created = HealthFacility.objects.get(code="tsthfb1", validity_to__isnull=True)
+        self.assertEqual(
+            HealthFacility.objects.get(code=self.test_hf.code, validity_to__isnull=True).name, "Renamed HF"
+        )
+        self.assertEqual(
+            mutation_log.json_ext["location_batch"]["results"],
+            [
+                {"code": "tsthfb1", "uuid": str(created.uuid)},
+                {"code": self.test_hf.code, "uuid": str(self.test_hf.uuid)},
+            ],
+        )
+        self.assertEqual(
+            set(mutation_log.health_facilities.values_list("health_facility_id", flat=True)),
+            {created.id, self.test_hf.id},
+        )
+
+    def test_mutation_create_or_update_health_facilities_all_or_nothing(self):
+        self._create_or_update_health_facilities(
+            "tsthfbatch2",
+            [
+                ("tsthfb2", "Batch HF", self.test_district.code),
+                ("tsthfb3", "Unknown location", "nope"),
+            ],
+        )
+        mutation_log = MutationLog.objects.get(client_mutation_id="tsthfbatch2")
+        self.assertEqual(mutation_log.status, MutationLog.ERROR)
+        self.assertEqual(len(json.loads(mutation_log.error)), 1)
+        self.assertFalse(HealthFacility.objects.filter(code__in=["tsthfb2", "tsthfb3"]).exists())
+        self.assertNotIn("location_batch", mutation_log.json_ext or {})
+
     def test_basic_HF_query(self):
         response = self.query(
             """
@@ -571,6 +825,29 @@ class HealthFacilityGQLTestCase(GraphQLTestCase):
         self.assertIsNotNone(content)
         self.assertResponseNoErrors(response)
 
+    def test_health_facilities_location_filter_applied_once(self):
+        query = """
+            {
+                healthFacilities(code: "%s") {
+                    edges { node { code } }
+                }
+            }
+        """ % self.test_hf.code
+        for row_security, filters, codes in ((True, 1, []), (False, 0, [self.test_hf.code])):
+            with self.settings(ROW_SECURITY=row_security), CaptureQueriesContext(connection) as queries:
+                response = self.query(
+                    query, headers={"HTTP_AUTHORIZATION": f"Bearer {self.noright_token}"}
+                )
+            self.assertResponseNoErrors(response)
+            content = json.loads(response.content)
+            self.assertEqual(
+                [edge["node"]["code"] for edge in content["data"]["healthFacilities"]["edges"]], codes
+            )
+            hf_queries = [q["sql"] for q in queries if q["sql"].startswith('SELECT') and 'FROM "tblHF"' in q["sql"]]
+            self.assertTrue(hf_queries)
+            for sql in hf_queries:
+                self.assertEqual(sql.count('"tblHF"."LocationId" IN'), filters, sql)
+
     def test_user_districts_admin(self):
 
         response = self.query(
@@ -1 +1,8 @@
-urlpatterns = []
+from django.urls import path
+
+from location import views
+
+urlpatterns = [
+    path("export/locations", views.export_locations),
+    path("export/health_facilities", views.export_health_facilities),
+]
@@ -1 +1,45 @@
-# Create your views here.
+from django.http import StreamingHttpResponse
+from django.utils.translation import gettext as _
+from django.views.decorators.http import require_GET
+from rest_framework import status
+from rest_framework.decorators import api_view
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.response import Response
+
+from .apps import LocationConfig
+from .exporters import export_lines
+
+EXPORT_CONTENT_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def _stream_export(request, what, perms):
+    if not request.user.has_perms(perms):
+        raise PermissionDenied(_("unauthorized"))
+    file_format = request.query_params.get("format", "csv")
+    if file_format not in EXPORT_CONTENT_TYPES:
+        return Response(
+            data="Unsupported file format.", status=status.HTTP_400_BAD_REQUEST
+        )
+    return StreamingHttpResponse(
+        export_lines(what, file_format, request.user),
+        content_type=EXPORT_CONTENT_TYPES[file_format],
+        headers={
+            "Content-Disposition": f'attachment; filename="{what}.{file_format}"'
+        },
+    )
+
+
+@api_view(["GET"])
+@require_GET
+def export_locations(request):
+    return _stream_export(
+        request, "locations", LocationConfig.gql_query_locations_perms
+    )
+
+
+@api_view(["GET"])
+@require_GET
+def export_health_facilities(request):
+    return _stream_export(
+        request, "health_facilities", LocationConfig.gql_query_health_facilities_perms
+    )